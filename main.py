@@ -9,8 +9,7 @@ from PySide6.QtCore import QRectF, QPointF
 # {'X': 120.48, 'Y': 112.78, 'Z': 8.95}
 
 def main_loop():
-    window.list_serial_ports()
-    window.check_serial()
+    # serial ports are watched on their own thread, see MainWindow.ports_changed
     window.game_pad_move()
     cam_num = window.ui.cam_input.text()
     try:
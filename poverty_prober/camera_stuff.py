@@ -2,8 +2,14 @@ import cv2
 import numpy as np
 from PySide6.QtWidgets import QInputDialog, QMessageBox
 import time
+import os
+import threading
 import json
 import importlib
+from .motion_stuff import compile_die_plan, run_plan
+from .capture_stuff import frame_grabber, frame_recorder
+from .focus_stuff import autofocus, focus_map
+from .vision_stuff import marks, roi_window, frame_pipeline, junction_corner, find_mark
 
 
 from pymeasure.adapters import VISAAdapter
@@ -37,11 +43,57 @@ class camera_handler():
         
         self.z_drop = 0
         self.prober = prober
+        # let the needles stop ringing after touchdown before reading the meter
+        self.settle_time = float(config["printer defaults"].get("settle time", 0.5))
+        # without camera correction a die is compiled into one gcode program and streamed
+        self.camera_correction = config.get("probing", {}).get("camera correction", "1") == "1"
+
+        # which registered mark geometry (vision_stuff.register_mark) this mask set uses
+        self.mark = config["camera"].get("mark", "cross")
+        # side of the square window the pipeline runs on, 0 processes the whole frame
+        self.roi_size = int(config["camera"].get("roi size", 0))
+        # window size when a point is asked for but no roi size is configured
+        self.default_roi = 400
+        # cap on the hough segments paired up when looking for a junction corner
+        self.max_hough_lines = int(config["camera"].get("max hough lines", 64))
+        # the die corner cross is looked for on an image scaled down by 2**pyramid_levels first
+        self.pyramid_levels = int(config["camera"].get("pyramid levels", 2))
+        self.mark_confidence = float(config["camera"].get("mark confidence", 0.2))
+
+        self.focuser = autofocus(self)
+        self.focus_every_die = config.get("focus", {}).get("every die", "1") == "1"
+        # once a few dies are focused, the rest start at the height this predicts
+        self.focus_map = focus_map()
+        # a predicted height is trusted when its score is at least this much of the usual in focus score
+        self.focus_verify = float(config.get("focus", {}).get("verify fraction", 0.8))
+        self.focus_refine_span = float(config.get("focus", {}).get("refine span", 0.03))
 
         self.cap = None
+        self.grabber = None
+        self.pipeline = None
+
+        # optional recording of what the camera saw, tagged with stage position and what plot_die was doing
+        self.recorder = None
+        self.last_recorded = None
+        self.activity = "live"
+        self.record_probing = config["camera"].get("record", "0") == "1"
+        self.record_mode = config["camera"].get("record mode", "video")
+        self.record_folder = config["camera"].get("record folder", "recordings")
+
+        # headless runs the analysis with no OpenCV windows, cancel() stops a probe job instead of ESC
+        self.headless = config["camera"].get("headless", "0") == "1"
+        display_fps = float(config["camera"].get("display fps", 30))
+        self.display_interval = 1.0/display_fps if display_fps > 0 else 0.0
+        self.last_display = 0.0
+        self.cancel_event = threading.Event()
         self.running = False
         self.align1 = []
         self.align2 = []
+        self.align_extra = []
+        # (machine center, wafer coords, Z) of every mark past the first two
+        self.extra_marks = []
+        # "similarity" or "affine", affine needs at least three marks
+        self.alignment_transform = config.get("alignment", {}).get("transform", "similarity")
         self.align1_center = None
         # {x,y}
 
@@ -83,10 +135,12 @@ class camera_handler():
             self.cap = cv2.VideoCapture(cam_number)
             if not self.cap.isOpened():
                 return False
-            cv2.namedWindow("real camera", cv2.WINDOW_NORMAL)
+            if not self.headless:
+                cv2.namedWindow("real camera", cv2.WINDOW_NORMAL)
+                cv2.setMouseCallback("real camera", self.click_handler, param=1)
             self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
             self.cap.set(cv2.CAP_PROP_FPS, 30)
-            cv2.setMouseCallback("real camera", self.click_handler, param=1)
+            self.grabber = frame_grabber(self.cap)
             self.cam_connected = True
 
             
@@ -95,17 +149,94 @@ class camera_handler():
     def stop_camera(self):
         """Stop camera thread"""
         self.running = False
+        if self.grabber:
+            self.grabber.stop()
+            self.grabber = None
         if self.cap:
             self.cap.release()
             self.cap = None
 
-    def update_camera(self):
-        
+    def grab_frame(self, after = None, roi = None):
+        """
+        Pipeline for the newest frame (or the first one taken after time after), stages are
+        computed on demand. Asking again for the same frame and window reuses what is done.
+        roi: None uses the configured window around the center, a full frame (x, y) centers
+        the window there, False processes the whole frame
+        """
+        if after is None:
+            grabbed = self.grabber.latest()
+        else:
+            grabbed = self.grabber.first_after(after)
+        if grabbed is None:
+            print("no frame from camera")
+            return None
+
+        frame_id, stamp, frame = grabbed
+        if self.recorder is not None and frame_id != self.last_recorded:
+            self.last_recorded = frame_id
+            xyz = self.prober.xyz
+            self.recorder.record(frame, {'frame id': frame_id, 'time': stamp, 'X': xyz['X'], 'Y': xyz['Y'],
+                                         'Z': xyz['Z'], 'stage': self.activity})
+        if roi is False:
+            window = roi_window(frame.shape, 0)
+        elif roi is None:
+            window = roi_window(frame.shape, self.roi_size)
+        else:
+            window = roi_window(frame.shape, self.roi_size or self.default_roi, roi)
+
+        if self.pipeline is None or self.pipeline.frame_id != frame_id or self.pipeline.window != window:
+            self.pipeline = frame_pipeline(frame_id, frame, window, marks[self.mark])
+        return self.pipeline
+
+    def start_recording(self, name = None):
+        """Record every frame the pipeline looks at until stop_recording, see capture_stuff.frame_recorder"""
+        self.stop_recording()
+        os.makedirs(self.record_folder, exist_ok=True)
+        if name is None:
+            name = "live"
+        path = os.path.join(self.record_folder, f"{time.strftime('%Y%m%d_%H%M%S')}_{name}")
+        self.recorder = frame_recorder(path, self.record_mode)
+        self.last_recorded = None
+        return path
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+
+    def cancel(self):
+        """Stop the running probe job at its next check, safe to call from any thread"""
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def update_camera(self, after = None, roi = None, overlay = True):
+        # after = time.time() once the stage stopped gets the first frame taken since then
+        # overlay = False only shows the camera, nothing gets processed for display
         if self.alignment_mode:
             return
 
+        pipeline = self.grab_frame(after, roi)
+        if pipeline is None:
+            return
 
-        ret, frame = self.cap.read()
+        self.show_frame(pipeline, overlay)
+
+        # stages cover only the roi window, add pipeline.origin to get back to frame pixels
+        return pipeline
+
+    def show_frame(self, pipeline, overlay = True):
+        # nothing in headless mode, otherwise at most display fps redraws a second
+        if self.headless:
+            return
+        now = time.time()
+        if now - self.last_display < self.display_interval:
+            return
+        self.last_display = now
+
+        # the grabber keeps its own copy, we draw on this one
+        frame = pipeline.frame.copy()
 
         #region crosshair
 
@@ -124,117 +255,14 @@ class camera_handler():
 
         cv2.imshow("real camera", frame)
 
-        #region vid processing
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        focus_measure = cv2.Laplacian(gray, cv2.CV_64F).var()
-
-
-
-        smoothed = cv2.GaussianBlur(gray, (3, 3), 1.2)
-        clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(8, 8))
-        enhanced = clahe.apply(smoothed)
-        binary = cv2.adaptiveThreshold(enhanced, 255,
-                               cv2.ADAPTIVE_THRESH_MEAN_C,
-                               cv2.THRESH_BINARY, blockSize=51, C=-5)
-        median = cv2.medianBlur(binary, 3)
-        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(median, connectivity=8)
-        final = np.zeros_like(median)
-
-        for i in range(1, num_labels):
-            if stats[i, cv2.CC_STAT_AREA] > 100:  # Adjust if small features are being removed
-                final[labels == i] = 255
-
-        final = cv2.dilate(final, np.ones((3, 3), np.uint8), iterations=1)
-        output = cv2.cvtColor(final, cv2.COLOR_GRAY2BGR)
-        #endregion
-
-        contours, _ = cv2.findContours(final, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        #region cross stuff
-        cross_template = np.zeros((300, 300), dtype=np.uint8)
-
-        # Define bar dimensions
-        bar_width =40
-        bar_length = 160
-        center = (150, 150)  # center of the canvas
-
-        # Draw vertical bar
-        x1 = center[0] - bar_width // 2
-        x2 = center[0] + bar_width // 2
-        y1 = center[1] - bar_length // 2
-        y2 = center[1] + bar_length // 2
-        cv2.rectangle(cross_template, (x1, y1), (x2, y2), 255, -1)
-
-        # Draw horizontal bar
-        x1 = center[0] - bar_length // 2
-        x2 = center[0] + bar_length // 2
-        y1 = center[1] - bar_width // 2
-        y2 = center[1] + bar_width // 2
-        cv2.rectangle(cross_template, (x1, y1), (x2, y2), 255, -1)
-
-        hole_size = 0
-        cv2.rectangle(
-            cross_template,
-            (center[0] - hole_size // 2, center[1] - hole_size // 2),
-            (center[0] + hole_size // 2, center[1] + hole_size // 2),
-            0,
-            -1
-        )
-
-
-        # Get contour of the template cross
-        cross_contours, _ = cv2.findContours(cross_template, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cross_template_contour = cross_contours[0]
-
-        #endregion
-
-        #region contour detection
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area < 500:
-                continue  # skip small stuff
-
-            score = cv2.matchShapes(cross_template_contour, cnt, cv2.CONTOURS_MATCH_I1, 0.0)
-
-            if score < 0.3:  # adjust threshold as needed
-                cv2.drawContours(output, [cnt], -1, (0, 255, 255), 2)
-
-                # Compute center of the shape
-                M = cv2.moments(cnt)                                                                                                                                                                                                                                                   
-                if M["m00"] != 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
-                    
-                    cv2.putText(output, "cross", (cx - 20, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
-
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area < 500:
-                continue
-
-            peri = cv2.arcLength(cnt, True)
-            approx = cv2.approxPolyDP(cnt, 0.02 * peri, True)
-
-            if len(approx) == 4 and cv2.isContourConvex(approx):
-                cv2.drawContours(output, [approx], -1, (0, 255, 0), 2)
-                M = cv2.moments(approx)
-                if M["m00"] != 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
-                    cv2.putText(output, "Square", (cx - 20, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
-                    
-        #endregion
-
-        # self.hough_lines_corner_find(smoothed)
-
-
-        cv2.imshow("processed image", output)
+        if overlay:
+            cv2.imshow("processed image", pipeline.get("overlay"))
 
         key = cv2.waitKey(1) & 0xFF
         if key == 13:
-             print(focus_measure)
-
-        return [final, smoothed, focus_measure, frame]
+             print(pipeline.get("focus"))
+        elif key == 27:  # ESC key
+            self.cancel()
 
     def generate_rotated_square(self, p1, p2):
         # Vector from p1 to p2
@@ -255,33 +283,46 @@ class camera_handler():
         if event == cv2.EVENT_LBUTTONDOWN:
             if param==1:
                 self.align1.append((x,y))
-            else:
+            elif param==2:
                 self.align2.append((x,y))
-
-    def align_1(self):
-        # Enter alignment mode and freeze frame
+            else:
+                self.align_extra.append((x,y))
+
+    def capture_mark(self, param):
+        """
+        Freeze the frame, let the user box an alignment mark with two clicks and type in its
+        wafer coordinates. Returns (machine center 2x1, wafer coords 2x1, Z) or None if cancelled.
+        param picks which click list the mouse fills, 1 and 2 for the two main marks.
+        """
         if self.alignment_mode == True:
-            return
+            return None
+        clicks_name = {1: "align1", 2: "align2"}.get(param, "align_extra")
 
+        # Enter alignment mode and freeze frame
         self.alignment_mode = True
-        self.align1 = []
+        setattr(self, clicks_name, [])
         
         # Capture and freeze the current frame
-        ret, self.frozen_frame = self.cap.read()
-        if not ret:
+        grabbed = self.grabber.latest()
+        if grabbed is None:
             self.alignment_mode = False
-            return
+            return None
+        self.frozen_frame = grabbed[2].copy()
 
-        cv2.setMouseCallback("real camera", self.click_handler, param=1)
-        
+        # alignment is done by clicking, so it gets the window even in headless mode
+        cv2.namedWindow("real camera", cv2.WINDOW_NORMAL)
+        cv2.setMouseCallback("real camera", self.click_handler, param=param)
+
+        mark = None
         while True:
             key = cv2.waitKey(1) & 0xFF
+            clicks = getattr(self, clicks_name)
             
             # Work with a copy of the frozen frame
             display_frame = self.frozen_frame
             
-            if len(self.align1) == 2:
-                square = self.generate_rotated_square(self.align1[0], self.align1[1])
+            if len(clicks) == 2:
+                square = self.generate_rotated_square(clicks[0], clicks[1])
                 cv2.polylines(display_frame, [np.array(square)], isClosed=True, color=(0, 255, 0), thickness=2)
                 
                 height, width = display_frame.shape[:2]
@@ -290,7 +331,7 @@ class camera_handler():
                 
             cv2.imshow("real camera", display_frame)
             
-            if key == 13 and len(self.align1) == 2:  # Enter key
+            if key == 13 and len(clicks) == 2:  # Enter key
                 text, ok = QInputDialog.getText(None, "Input", "enter theoretical coords of this box in x,y format:")
                 if ok:
                     wide, ok = QInputDialog.getText(None, "Input", "how many micron per side of square")
@@ -303,106 +344,91 @@ class camera_handler():
                         temp = 0.001*self.microns_per_pixel*(pixel_offset)
 
                         xyz = self.prober.find_location()
-                        self.z1 = xyz['Z']
-                        self.align1_center = np.array([[xyz['X']+temp[0,0]],[xyz['Y']-temp[1,0]]])
+                        center = np.array([[xyz['X']+temp[0,0]],[xyz['Y']-temp[1,0]]])
                         x, y = text.split(",")
-                        self.align1_real = np.array([[float(x)],[float(y)]])
-                        self.alignment_mode = False        
-
+                        mark = (center, np.array([[float(x)],[float(y)]]), xyz['Z'])
                         break
                     else:
-                        self.align1 = []
-                        self.alignment_mode = False        
-
+                        setattr(self, clicks_name, [])
                         break
                 else:
-                    self.align1 = []
-                    self.alignment_mode = False        
-
+                    setattr(self, clicks_name, [])
                     break
             elif key == 27:  # Escape key
-                self.alignment_mode = False        
-
                 break
         # Exit alignment mode
         self.alignment_mode = False        
+        return mark
 
-    def align_2(self):
-        if self.alignment_mode == True:
-            return
-        # Enter alignment mode and freeze frame
-        self.alignment_mode = True
-        self.align2 = []
-        
-        # Capture and freeze the current frame
-        ret, self.frozen_frame = self.cap.read()
-        if not ret:
-            self.alignment_mode = False
-            return
-
-        cv2.setMouseCallback("real camera", self.click_handler, param=2)
-        
-        while True:
-            key = cv2.waitKey(1) & 0xFF
-
-            # Work with a copy of the frozen frame
-            display_frame = self.frozen_frame
-            
-            if len(self.align2) == 2:
-                square = self.generate_rotated_square(self.align2[0], self.align2[1])
-                cv2.polylines(display_frame, [np.array(square)], isClosed=True, color=(0, 255, 0), thickness=2)
-                
-                height, width = display_frame.shape[:2]
-                screen_center = np.array([[width//2],[height//2]])
-                pixel_center = np.mean(np.array(square), axis=0).reshape(2, 1)
-                
-            cv2.imshow("real camera", display_frame)
-            key = cv2.waitKey(1) & 0xFF
-
-            if key == 13 and len(self.align2) == 2:  # Enter key
-                text, ok = QInputDialog.getText(None, "Input", "enter theoretical coords of this box in x,y format:")
-                if ok:
-                    wide, ok = QInputDialog.getText(None, "Input", "how many micron per side of square")
-                    if ok:
-                        wide = float(wide)
-                        pixels = np.hypot(square[0][0]-square[1][0], square[0][1]-square[1][1])
-                        self.microns_per_pixel = float(wide/pixels)
-
-                        pixel_offset = pixel_center - screen_center
-                        temp = 0.001*self.microns_per_pixel*(pixel_offset)
-
-                        xyz = self.prober.find_location()
-                        self.z2 = xyz['Z']
-                        self.align2_center = np.array([[xyz['X']+temp[0,0]],[xyz['Y']-temp[1,0]]])
-                        x, y = text.split(",")
-                        self.align2_real = np.array([[float(x)],[float(y)]])
-                        self.alignment_mode = False        
-
-                        break
-                    else:
-                        self.align2 = []
-                        self.alignment_mode = False        
-
-                        break
-                else:
-                    self.align2 = []
-                    self.alignment_mode = False        
-
-                    break
-            elif key == 27:  # Escape key
-                self.alignment_mode = False        
+    def align_1(self):
+        mark = self.capture_mark(1)
+        if mark is not None:
+            self.align1_center, self.align1_real, self.z1 = mark
+            # a new main mark starts a new alignment, extras from the last one would skew it
+            self.clear_alignment_marks()
 
-                break
-        # Exit alignment mode
-        self.alignment_mode = False        
+    def align_2(self):
+        mark = self.capture_mark(2)
+        if mark is not None:
+            self.align2_center, self.align2_real, self.z2 = mark
+            self.clear_alignment_marks()
+
+    def add_alignment_mark(self):
+        """Any number of marks on top of the two main ones, they all go into the least squares fit"""
+        mark = self.capture_mark(3)
+        if mark is not None:
+            self.extra_marks.append(mark)
+            print(f"{len(self.extra_marks) + 2} alignment marks")
+
+    def clear_alignment_marks(self):
+        if self.extra_marks:
+            print(f"cleared {len(self.extra_marks)} extra alignment marks")
+        self.extra_marks = []
+
+    def add_height_sample(self, touchdown = False):
+        """
+        Add where the needles are now to the height map. Focus on the wafer here first, or with
+        touchdown lower the needles onto it, then the sample is z_drop steps above that.
+        """
+        if not self.aligned:
+            print("align first, the height map starts from the alignment marks")
+            return None
+        # the stage sits where focusing left it, level_offset included, and that is the sample
+        xyz = self.prober.current_location()
+        z = xyz['Z']
+        if touchdown:
+            z += self.z_drop * 0.04
+        error = self.prober.add_height_sample(xyz['X'], xyz['Y'], z)
+        # focus offsets were measured against the old map, start them over on the new one
+        self.focus_map.clear()
+        print(f"{len(self.prober.heights)} height samples, map was {error*1000:+.1f} um off here")
+        return error
 
 
     
     def apply_transformation(self):
         if self.align1_center is not None and self.align2_center is not None:
             # Ask if user wants visual confirmation
-            self.prober.apply_transformation(self.align1_center, self.align2_center, self.align1_real, self.align2_real, self.z1, self.z2)
+            marks = [(self.align1_center, self.align1_real, self.z1),
+                     (self.align2_center, self.align2_real, self.z2)] + self.extra_marks
+            count_msg = QMessageBox()
+            count_msg.setWindowTitle("Confirm Alignment")
+            count_msg.setText(f"Fit the alignment through {len(marks)} marks (marks 1 and 2 and {len(self.extra_marks)} extra)?")
+            count_msg.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+            count_msg.setDefaultButton(QMessageBox.StandardButton.Yes)
+            if count_msg.exec() != QMessageBox.StandardButton.Yes:
+                return
+            residuals = self.prober.fit_alignment(np.hstack([mark[0] for mark in marks]),
+                                                  np.hstack([mark[1] for mark in marks]),
+                                                  [mark[2] for mark in marks], self.alignment_transform)
+            residual_text = "\n".join(f"mark {i + 1}: X {r['X']*1000:+.1f} um, Y {r['Y']*1000:+.1f} um, Z {r['Z']*1000:+.1f} um"
+                                      for i, r in enumerate(residuals))
+            print(residual_text)
             self.aligned = True
+            # focus offsets were relative to the old alignment
+            self.focus_map.clear()
+            # they are in this fit now, the next alignment starts from marks 1 and 2 again
+            self.clear_alignment_marks()
 
             visual_confirm_msg = QMessageBox()
             visual_confirm_msg.setWindowTitle("Visual Confirmation")
@@ -465,7 +491,7 @@ class camera_handler():
             
             final_msg = QMessageBox()
             final_msg.setWindowTitle("Alignment Complete")
-            final_msg.setText("Transformation applied successfully. System is now aligned.")
+            final_msg.setText("Transformation applied successfully. System is now aligned.\n\nFit residuals:\n" + residual_text)
             final_msg.exec()
             
         else:
@@ -483,6 +509,28 @@ class camera_handler():
 
 
     def plot_die(self, die_size_mm, points_to_probe, die_center, die_object):
+        self.cancel_event.clear()
+        if self.record_probing:
+            self.start_recording(f"die_{die_center[0,0]:.3f}_{die_center[1,0]:.3f}")
+        try:
+            return self.probe_die(die_size_mm, points_to_probe, die_center, die_object)
+        except (TimeoutError, ConnectionError) as e:
+            # needles may be down, lifting them again from up only adds clearance
+            print(f"printer stopped answering while probing: {e}")
+            self.prober.turn_off_measuring()
+            if self.z_drop:
+                self.prober.rel_move(0, 0, self.z_drop * 0.04, 200)
+            return "bork"
+        finally:
+            self.stop_recording()
+            self.activity = "live"
+
+    def wait_for_stage(self):
+        # a printer that stopped answering never moved, plot_die lifts the needles and gives up
+        if not self.prober.wait_for_idle():
+            raise TimeoutError("printer never finished the last move")
+
+    def probe_die(self, die_size_mm, points_to_probe, die_center, die_object):
         
         failed_probe = coords = np.empty((2, 0))
 
@@ -519,115 +567,58 @@ class camera_handler():
             return "bork"
             
 
-        self.prober.transformed_move(die_center, True)
+        predicted = None
+        if self.focus_every_die:
+            predicted = self.focus_map.predict(die_center)
+            if predicted is not None:
+                self.prober.level_offset = predicted
+
+        self.prober.transformed_move(die_center)
+        self.wait_for_stage()
         # print('sigma')
 
 
-        fuzziness = self.update_camera()[2]
-        down = True
-        while fuzziness < 0:
-            prev = fuzziness
-            if down:
-                self.prober.rel_move(0,0,-0.04,200)
-                time.sleep(1)
-                fuzziness = self.update_camera()[2]
-                if fuzziness < prev:
-                    down = False
-            else:
-                self.prober.rel_move(0,0,0.04,200)
-                time.sleep(1)
-                fuzziness = self.update_camera()[2]
+        if self.focus_every_die:
+            self.activity = "focus"
+            self.focus_die(die_center, predicted is not None)
 
 
 
 
-        for i in range(3):
-            self.update_camera()
-            key = cv2.waitKey(1) & 0xFF
-            if key == 27:  # ESC key
-                # print("ESC pressed, exiting")
-                return "bork"
+        self.update_camera(overlay=False)
+        if self.cancelled():
+            # print("ESC pressed, exiting")
+            return "bork"
         temp = np.array([[die_size_mm/2],[die_size_mm/2]])
-        self.prober.transformed_move(die_center+temp, True)
-        time.sleep(2)
-
-
-        #region
-        cross_template = np.zeros((300, 300), dtype=np.uint8)
-
-        # Define bar dimensions
-        bar_width = 40
-        bar_length = 160
-        center = (150, 150)  # center of the canvas
-
-        # Draw vertical bar
-        x1 = center[0] - bar_width // 2
-        x2 = center[0] + bar_width // 2
-        y1 = center[1] - bar_length // 2
-        y2 = center[1] + bar_length // 2
-        cv2.rectangle(cross_template, (x1, y1), (x2, y2), 255, -1)
-
-        # Draw horizontal bar
-        x1 = center[0] - bar_length // 2
-        x2 = center[0] + bar_length // 2
-        y1 = center[1] - bar_width // 2
-        y2 = center[1] + bar_width // 2
-        cv2.rectangle(cross_template, (x1, y1), (x2, y2), 255, -1)
-
-        hole_size = 0
-        cv2.rectangle(
-            cross_template,
-            (center[0] - hole_size // 2, center[1] - hole_size // 2),
-            (center[0] + hole_size // 2, center[1] + hole_size // 2),
-            0,
-            -1
-        )
-        cross_contours, _ = cv2.findContours(cross_template, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cross_template_contour = cross_contours[0]
-
-        #endregion
+        self.prober.transformed_move(die_center+temp)
+        self.wait_for_stage()
 
-        closest_cross_center = None
-        closest_distance = float('inf')
 
+        cross = marks[self.mark]
+        self.activity = "cross search"
 
-        for i in range(10):
-            final = self.update_camera()[0]
-            key = cv2.waitKey(1) & 0xFF
-            if key == 27:  # ESC key
-                # print("ESC pressed, exiting")
-                return "bork"
-
-        time.sleep(5)
 
-        contours, _ = cv2.findContours(final, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # the move above waited for the stage, so the first frame after now is a settled one
+        pipeline = self.update_camera(after=time.time(), overlay=False)
+        if pipeline is None:
+            return "bork"
+        origin = pipeline.origin
+        if self.cancelled():
+            # print("ESC pressed, exiting")
+            return "bork"
 
-        height, width = final.shape[:2]
+        # everything from here on is in full frame pixels
+        height, width = pipeline.frame.shape[:2]
         img_center = np.array([[width // 2], [height // 2]])
 
+        closest_cross_center, confidence = find_mark(pipeline.get("smoothed"), cross,
+                                                     (img_center - origin)[:, 0], self.pyramid_levels)
 
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area < 300:
-                continue  # skip small stuff
-
-            score = cv2.matchShapes(cross_template_contour, cnt, cv2.CONTOURS_MATCH_I1, 0.0)
-
-            if score < 0.45:
-                M = cv2.moments(cnt)
-                if M["m00"] != 0:
-                    cx = int(M["m10"] / M["m00"])
-                    cy = int(M["m01"] / M["m00"])
-                    distance = np.hypot(cx - img_center[0,0], cy - img_center[1,0])
-
-                    if distance < closest_distance:
-                        closest_distance = distance
-                        closest_cross_center = np.array([[cx],[cy]])
-
-        if closest_cross_center is None:
-            pixel_offset = np.array([[0],[0]])
-
-        pixel_offset = closest_cross_center - img_center
+        if closest_cross_center is None or confidence < self.mark_confidence:
+            print(f"no die corner cross found (confidence {confidence:.2f}), probing uncorrected")
+            pixel_offset = np.array([[0.0],[0.0]])
+        else:
+            pixel_offset = closest_cross_center + origin - img_center
         pixel_offset[1,0] = pixel_offset[1,0] * -1  
         temp2 = 0.001*self.microns_per_pixel*(pixel_offset)
         # displacement += temp2  
@@ -639,114 +630,112 @@ class camera_handler():
 
         baseline = baseline/10
 
-        for i in range(points_to_probe.shape[1]):
-            xy = np.array([[points_to_probe[0,i]],[points_to_probe[1,i]]])
-            xy = xy + die_center
+        self.activity = "junction"
+        if not self.camera_correction:
+            failed_probe = self.probe_compiled(points_to_probe, die_center, die_object, baseline)
+            if failed_probe is None:
+                return "bork"
+        else:
+            for i in range(points_to_probe.shape[1]):
+                xy = np.array([[points_to_probe[0,i]],[points_to_probe[1,i]]])
+                xy = xy + die_center
 
-            self.prober.transformed_move(xy)
-            
-            time.sleep(2)
+                self.prober.transformed_move(xy)
+                self.wait_for_stage()
 
-            final = self.update_camera()[1]
+                pipeline = self.update_camera(after=time.time(), overlay=False)
             
-            key = cv2.waitKey(1) & 0xFF
 
 
-            probe_center, boost = self.hough_lines_corner_find(final)
-            pixel_offset = probe_center - img_center
-            temp2 = 0.001*self.microns_per_pixel*(pixel_offset)
+                probe_center, boost = self.hough_lines_corner_find(pipeline.get("smoothed"), pipeline.origin, img_center)
+                pixel_offset = probe_center - img_center
+                temp2 = 0.001*self.microns_per_pixel*(pixel_offset)
 
-            if temp2[0,0] > 0.05:
-                self.prober.rel_move(-0.06, 0, None, 200)
-            if temp2[0,0] < -0.05:
-                self.prober.rel_move(0.06, 0, None, 200)
+                if temp2[0,0] > 0.05:
+                    self.prober.rel_move(-0.06, 0, None, 200)
+                if temp2[0,0] < -0.05:
+                    self.prober.rel_move(0.06, 0, None, 200)
             
             
-            if boost != 0:
-                self.prober.rel_move(0, boost*0.06, None, 200)
-                print(f"boosted {boost}")
-            if temp2[1,0] > 0.03:
-                self.prober.rel_move(0, 0.06, None, 200)
-            if temp2[1,0] < -0.03:
-                self.prober.rel_move(0, -0.06, None, 200)
+                if boost != 0:
+                    self.prober.rel_move(0, boost*0.06, None, 200)
+                    print(f"boosted {boost}")
+                if temp2[1,0] > 0.03:
+                    self.prober.rel_move(0, 0.06, None, 200)
+                if temp2[1,0] < -0.03:
+                    self.prober.rel_move(0, -0.06, None, 200)
         
-            final = self.update_camera()[1] 
-            key = cv2.waitKey(1) & 0xFF
+                self.update_camera(overlay=False)
 
 
 
-            if key == 27:  # ESC key
-                # print("ESC pressed, exiting")
-                return "bork"
+                if self.cancelled():
+                    # print("ESC pressed, exiting")
+                    return "bork"
 
-            time.sleep(1)
-            final = self.update_camera()[1] 
-            key = cv2.waitKey(1) & 0xFF
+                self.wait_for_stage()
+                self.update_camera(overlay=False)
 
 
-            self.prober.rel_move(0,0,(-self.z_drop * 0.04),200)
+                self.prober.rel_move(0,0,(-self.z_drop * 0.04),200)
             
 
 
-            self.prober.turn_on_measuring()
+                self.prober.turn_on_measuring()
 
+                self.wait_for_stage()
+                time.sleep(self.settle_time)
             
+                resistance = 0
+                for x in range(10):
+                    resistance += self.multimeter.resistance
 
-            time.sleep(3)
-            
-            resistance = 0
-            for x in range(10):
-                resistance += self.multimeter.resistance
+                resistance = resistance/10
 
-            resistance = resistance/10
+                resistance = resistance - baseline
 
-            resistance = resistance - baseline
+                if resistance > 1000000:
+                    failed_probe = np.hstack((failed_probe, xy))
 
-            if resistance > 1000000:
-                failed_probe = np.hstack((failed_probe, xy))
+                # print(resistance)
 
-            # print(resistance)
+                totoro = np.array([[points_to_probe[0,i]],[points_to_probe[1,i]]])
 
-            totoro = np.array([[points_to_probe[0,i]],[points_to_probe[1,i]]])
-
-            die_object.insert_probed_resistance(totoro, resistance)
+                die_object.insert_probed_resistance(totoro, resistance)
             
 
-            self.prober.turn_off_measuring()
-            key = cv2.waitKey(1) & 0xFF
+                self.prober.turn_off_measuring()
 
-            final = self.update_camera()[1]
-            if key == 27:  # ESC key
-                # print("ESC pressed, exiting")
-                return "bork"
+                self.update_camera(overlay=False)
+                if self.cancelled():
+                    # print("ESC pressed, exiting")
+                    return "bork"
 
-            time.sleep(3)
+                self.wait_for_stage()
 
-            self.prober.rel_move(0,0,(self.z_drop * 0.04),200)
+                self.prober.rel_move(0,0,(self.z_drop * 0.04),200)
 
-            final = self.update_camera()[1]
-            key = cv2.waitKey(1) & 0xFF
+                self.update_camera(overlay=False)
 
-            if key == 27:  # ESC key
-                # print("ESC pressed , exiting")
-                return "bork"
+                if self.cancelled():
+                    # print("ESC pressed , exiting")
+                    return "bork"
 
         #reprobe failed junctions
+        self.activity = "reprobe"
 
         for i in range(failed_probe.shape[1]):
             xy = np.array([[failed_probe[0,i]],[failed_probe[1,i]]])
             xy = xy + die_center
 
             self.prober.transformed_move(xy)
-            
-            time.sleep(2)
+            self.wait_for_stage()
 
-            final = self.update_camera()[1]
+            pipeline = self.update_camera(after=time.time(), overlay=False)
             
-            key = cv2.waitKey(1) & 0xFF
 
 
-            probe_center, boost = self.hough_lines_corner_find(final)
+            probe_center, boost = self.hough_lines_corner_find(pipeline.get("smoothed"), pipeline.origin, img_center)
             pixel_offset = probe_center - img_center
             temp2 = 0.001*self.microns_per_pixel*(pixel_offset)
 
@@ -764,16 +753,15 @@ class camera_handler():
             if temp2[1,0] < -0.03:
                 self.prober.rel_move(0, -0.06, None, 200)
         
-            final = self.update_camera()[1] 
-            key = cv2.waitKey(1) & 0xFF
+            self.update_camera(overlay=False)
 
 
 
-            if key == 27:  # ESC key
+            if self.cancelled():
                 # print("ESC pressed, exiting")
                 return "bork"
 
-            time.sleep(1)
+            self.wait_for_stage()
 
             baseline = 0
 
@@ -787,7 +775,8 @@ class camera_handler():
             
             self.prober.turn_on_measuring()
 
-            time.sleep(3)
+            self.wait_for_stage()
+            time.sleep(self.settle_time)
             
             resistance = 0
             for x in range(10):
@@ -804,115 +793,164 @@ class camera_handler():
             die_object.insert_probed_resistance(totoro, resistance)
             
             self.prober.turn_off_measuring()
-            key = cv2.waitKey(1) & 0xFF
 
-            final = self.update_camera()[1]
-            if key == 27:  # ESC key
+            self.update_camera(overlay=False)
+            if self.cancelled():
                 # print("ESC pressed, exiting")
                 return "bork"
 
-            time.sleep(3)
+            self.wait_for_stage()
 
             self.prober.rel_move(0,0,(self.z_drop * 0.04),200)
 
-            final = self.update_camera()[1]
-            key = cv2.waitKey(1) & 0xFF
+            self.update_camera(overlay=False)
 
-            if key == 27:  # ESC key
+            if self.cancelled():
                 # print("ESC pressed , exiting")
                 return "bork"
 
     
-    def hough_lines_corner_find(self, img):
-        def line_angle(x1, y1, x2, y2):
-            return np.arctan2(y2 - y1, x2 - x1)  # Radians
-        
-        def angle_diff(theta1, theta2):
-            diff = np.abs(theta1 - theta2)
-            return min(diff, np.pi - diff)  # Smallest angle between the lines
-
-        def are_approximately_perpendicular(theta1, theta2, threshold_deg=10):
-            diff_rad = np.deg2rad(threshold_deg)
-            return np.abs(angle_diff(theta1, theta2) - np.pi / 2) < diff_rad
-        
-        def compute_intersection(line1, line2):
-            x1, y1, x2, y2 = line1
-            x3, y3, x4, y4 = line2
-
-            A1, B1 = y2 - y1, x1 - x2
-            C1 = A1 * x1 + B1 * y1
-            A2, B2 = y4 - y3, x3 - x4
-            C2 = A2 * x3 + B2 * y3
-
-            det = A1 * B2 - A2 * B1
-            if det == 0:
-                return None  # parallel lines
-            x = (B2 * C1 - B1 * C2) / det
-            y = (A1 * C2 - A2 * C1) / det
-            return int(x), int(y)
-
-        closestpoints = np.empty((3, 0))
-
-        edges = cv2.Canny(img, 50, 150, apertureSize=3)
+    def focus_die(self, die_center, predicted = False):
+        """
+        Focus on the die we are parked over and level the rest of it to that height. When the
+        height came from the focus map, one frame checks it and only a short search fixes it up.
+        """
+        start_z = self.prober.current_location()['Z']
+        if predicted:
+            pipeline = self.update_camera(after=time.time(), overlay=False)
+            expected = self.focus_map.expected_score()
+            if pipeline is not None and pipeline.focus(self.focuser.method) >= expected*self.focus_verify:
+                return None
+            focus = self.focuser.run(self.focus_refine_span)
+        else:
+            focus = self.focuser.run()
 
-        lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=20, minLineLength=50, maxLineGap=10)
+        if focus is not None:
+            # the rest of this die is leveled to where it came into focus
+            self.prober.level_offset += focus['Z'] - start_z
+            self.focus_map.add(die_center, self.prober.level_offset, focus['score'])
+        return focus
 
+    def read_resistance(self, samples = 10):
+        resistance = 0
+        for x in range(samples):
+            resistance += self.multimeter.resistance
 
+        return resistance/samples
 
-        height, width = img.shape[:2]
-        screen_center = np.array([[width//2],[height//2]])
+    def probe_compiled(self, points_to_probe, die_center, die_object, baseline):
+        # the whole die goes out as one gcode block, we only stop where the needles are down
+        failed_probe = np.empty((2, 0))
+        plan = compile_die_plan(self.prober, points_to_probe, die_center, self.z_drop)
+        steps = run_plan(self.prober, plan)
 
-        
-        if lines is None:
-            # print("No lines detected by HoughLinesP")
-            # Return screen center as fallback
-            return screen_center, 0
-
-
-        for i in range(len(lines)):
-            for j in range(i + 1, len(lines)):
-                l1, l2 = lines[i][0], lines[j][0]
-                theta1 = line_angle(*l1)
-                theta2 = line_angle(*l2)
-                if are_approximately_perpendicular(theta1, theta2):
-                    pt = compute_intersection(l1, l2)
-                    if pt:
-                        if closestpoints.shape[1] < 4:
-
-                            distance = np.hypot(pt[0] - screen_center[0,0], pt[1] - screen_center[1,0])
-                            new_point = np.array([[pt[0]], [pt[1]], [distance]])
-                            closestpoints = np.hstack((closestpoints, new_point))
-                            sorted_indices = np.argsort(closestpoints[2])  # Sort based on row index 2
-                            closestpoints = closestpoints[:, sorted_indices]
-                        else:
-                            distance = np.hypot(pt[0] - screen_center[0,0], pt[1] - screen_center[1,0])
-                            new_point = np.array([[pt[0]], [pt[1]], [distance]])
-                            closestpoints = np.hstack((closestpoints, new_point))
-                            sorted_indices = np.argsort(closestpoints[2])  # Sort based on row index 2
-                            closestpoints = closestpoints[:, sorted_indices]
-                            closestpoints = np.delete(closestpoints, -1, axis=1)
-                        # cv2.circle(output, pt, 4, (0, 255, 0), -1)
-        
+        for i in steps:
+            time.sleep(self.settle_time)
 
-        x = closestpoints[0]
-        y = closestpoints[1]
+            resistance = self.read_resistance() - baseline
 
-        all_less = np.all(closestpoints[1, :] < screen_center[1,0])
+            xy = np.array([[points_to_probe[0,i]],[points_to_probe[1,i]]])
+            if resistance > 1000000:
+                failed_probe = np.hstack((failed_probe, xy + die_center))
+
+            die_object.insert_probed_resistance(xy, resistance)
+
+            self.update_camera(overlay=False)
+            if self.cancelled():
+                steps.close()
+                return None
+
+        if plan.error is not None:
+            # run_plan already sent the rest of the point, needles up
+            return None
+        return failed_probe
+
+    def hough_lines_corner_find(self, img, origin = None, center = None):
+        """
+        Junction corner nearest the screen center, in full frame pixels. img may be an roi
+        crop from update_camera, origin is where it sits in the frame and center the frame
+        center (defaults to the middle of img).
+        """
+        return junction_corner(img, origin, center, self.max_hough_lines)
+
+    def settled_frame(self):
+        # None when the camera gave nothing
+        self.prober.wait_for_idle()
+        pipeline = self.update_camera(after=time.time(), overlay=False)
+        if pipeline is None:
+            return None
+        return np.float32(pipeline.get("smoothed"))
+
+    def measure_backlash(self, axis, travel = 0.5, repeats = 3):
+        """Approach the current spot from both sides and see how far apart the two images land, in mm. None without frames"""
+        step = {'X': (travel, 0), 'Y': (0, travel)}[axis]
+        index = 0 if axis == 'X' else 1
+        results = []
+        for i in range(repeats):
+            # come in from below
+            self.prober.rel_move(-step[0], -step[1], None, 200)
+            self.prober.rel_move(step[0], step[1], None, 200)
+            from_below = self.settled_frame()
+
+            # come back to the same commanded spot from above
+            self.prober.rel_move(step[0], step[1], None, 200)
+            self.prober.rel_move(-step[0], -step[1], None, 200)
+            from_above = self.settled_frame()
+            if from_below is None or from_above is None:
+                print("no frame from camera, backlash not measured")
+                return None
+
+            shift, response = cv2.phaseCorrelate(from_below, from_above)
+            results.append(abs(shift[index]) * self.microns_per_pixel * 0.001)
+        return float(np.median(results))
+
+    def calibrate_backlash(self, axis, positions = None, travel = 0.5, repeats = 3):
+        """
+        Measure backlash on one axis at each machine position (or just here) and store it in
+        the prober's compensation table, bands reach halfway to the neighbouring positions.
+        Needs microns_per_pixel, so run it after an alignment mark has been set.
+        """
+        if self.microns_per_pixel is None or not self.cam_connected:
+            msg = QMessageBox()
+            msg.setWindowTitle("Error")
+            msg.setText("Connect the camera and set an alignment mark before calibrating backlash")
+            msg.exec()
+            return None
 
-        all_more = np.all(closestpoints[1, :] > screen_center[1,0])
+        xyz = self.prober.find_location()
+        if positions is None:
+            positions = [xyz[axis]]
+        positions = sorted(positions)
 
-        if all_less:
-            boost = 1
-        elif all_more:
-            boost = -1
+        measured = []
+        try:
+            for position in positions:
+                if axis == 'X':
+                    self.prober.abs_move(position, xyz['Y'], wait = True)
+                else:
+                    self.prober.abs_move(xyz['X'], position, wait = True)
+                backlash = self.measure_backlash(axis, travel, repeats)
+                if backlash is None:
+                    return None
+                measured.append(backlash)
+                print(f"{axis} backlash at {position:.2f}: {measured[-1]:.4f} mm")
+        finally:
+            # the raw moves above left the direction flags behind, end coming in from below so they are true again
+            step = {'X': (travel, 0), 'Y': (0, travel)}[axis]
+            self.prober.rel_move(-step[0], -step[1], None, 200)
+            self.prober.rel_move(step[0], step[1], None, 200)
+            self.prober.reset_backlash_direction(axis)
+
+        if len(positions) == 1:
+            if axis == 'X':
+                self.prober.x_backlash = measured[0]
+            else:
+                self.prober.y_backlash = measured[0]
+            self.prober.set_backlash_table(axis, [])
         else:
-            boost = 0
-
-        centroid_x = np.mean(x)
-        centroid_y = np.mean(y)
-        centroid = np.array([[centroid_x],[centroid_y]])
-
-        return centroid, boost
+            edges = [-float('inf')] + [(a + b)/2 for a, b in zip(positions, positions[1:])] + [float('inf')]
+            self.prober.set_backlash_table(axis, [(edges[i], edges[i+1], measured[i]) for i in range(len(positions))])
+        return measured
 
     def set_drop_dist(self):
         text, ok = QInputDialog.getText(None, "Z drop dist", "enter number of steps to drop to probe Z:")
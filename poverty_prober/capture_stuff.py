@@ -0,0 +1,183 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+import json
+import cv2
+import numpy as np
+
+
+class frame_grabber():
+    """
+    Reads a cv2.VideoCapture on its own thread and keeps the last few frames as
+    (frame id, timestamp, frame). Nobody else should call cap.read() while this runs.
+    The timestamp is when read() returned, the frame was exposed up to a frame period before.
+    """
+    def __init__(self, cap, size = 8):
+        self.cap = cap
+        self.frames = deque(maxlen=size)
+        self.frame_id = 0
+        # running average of the time between frames, None until two have come in
+        self.period = None
+        self.lock = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            ret, frame = self.cap.read()
+            if not ret:
+                time.sleep(0.01)
+                continue
+            stamp = time.time()
+            with self.lock:
+                if self.frames:
+                    interval = stamp - self.frames[-1][1]
+                    self.period = interval if self.period is None else 0.9*self.period + 0.1*interval
+                self.frame_id += 1
+                self.frames.append((self.frame_id, stamp, frame))
+                self.lock.notify_all()
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=1)
+
+    def latest(self, timeout = 2.0):
+        """Newest frame, waits for the first one if nothing has come in yet. None on timeout"""
+        with self.lock:
+            if not self.lock.wait_for(lambda: len(self.frames) > 0, timeout):
+                return None
+            return self.frames[-1]
+
+    def exposed_after(self, t):
+        # caller holds self.lock. Many backends ignore CAP_PROP_BUFFERSIZE, so a frame read just after
+        # t can have been exposed before it. Skip a frame period, or the first frame while it is unknown
+        if self.period is None:
+            return [frame for frame in self.frames if frame[1] > t][1:]
+        return [frame for frame in self.frames if frame[1] > t + self.period]
+
+    def first_after(self, t, timeout = 2.0):
+        """Oldest frame exposed after time t, so a frame taken once the stage has settled. None on timeout"""
+        with self.lock:
+            if not self.lock.wait_for(lambda: len(self.exposed_after(t)) > 0, timeout):
+                return None
+            return self.exposed_after(t)[0]
+
+
+class frame_recorder():
+    """
+    Writes frames to disk on its own thread so whoever hands them over never waits on the disk.
+    mode "raw" appends uncompressed frames to path + ".raw" (open it again with read_recording,
+    which memory maps it), "video" compresses them into path + ".mp4". Either way every frame's
+    tags (frame id, time, stage position, what the frame was used for) go to path + ".jsonl".
+    When the queue is full frames are dropped and counted rather than blocking.
+    """
+    def __init__(self, path, mode = "raw", fps = 30, queue_size = 64):
+        self.path = path
+        self.mode = mode
+        self.fps = fps
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, frame, tags):
+        try:
+            self.queue.put_nowait((frame, tags))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self, wait = False, timeout = 2.0):
+        """
+        Tell the writer to finish what is queued and close the files. Never blocks for more than
+        about timeout seconds, a full queue loses its oldest frame to make room for the stop and a
+        dead writer is just reported. With wait, also give the writer timeout seconds to finish.
+        False if the writer did not get the message or did not finish in time.
+        """
+        if not self.thread.is_alive():
+            print("recorder thread already stopped")
+            return False
+        try:
+            self.queue.put((None, None), timeout=timeout)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+                self.queue.put_nowait((None, None))
+            except (queue.Empty, queue.Full):
+                print("recorder queue stuck, stop not delivered")
+                return False
+        if wait:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def run(self):
+        data = None
+        video = None
+        shape = None
+        with open(self.path + ".jsonl", "w") as index:
+            while True:
+                frame, tags = self.queue.get()
+                if frame is None:
+                    break
+                if shape is None:
+                    shape = frame.shape
+                    if self.mode == "video":
+                        fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+                        video = cv2.VideoWriter(self.path + ".mp4", fourcc, self.fps, (shape[1], shape[0]))
+                    else:
+                        data = open(self.path + ".raw", "wb")
+                if frame.shape != shape:
+                    # a raw store has one frame size, a camera switch mid run would garble it
+                    self.dropped += 1
+                    continue
+
+                if video is not None:
+                    video.write(frame)
+                else:
+                    data.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+                tags = dict(tags)
+                tags['index'] = self.written
+                tags['shape'] = list(shape)
+                index.write(json.dumps(tags) + "\n")
+                self.written += 1
+
+        if video is not None:
+            video.release()
+        if data is not None:
+            data.close()
+        if self.dropped:
+            print(f"recorder dropped {self.dropped} frames")
+
+
+def read_recording(path):
+    """
+    (tags, frame) for every frame a frame_recorder wrote under path. Raw stores are memory
+    mapped, so frames are only read from disk when they are looked at.
+    """
+    tags = []
+    if os.path.exists(path + ".jsonl"):
+        with open(path + ".jsonl", "r") as index:
+            tags = [json.loads(line) for line in index if line.strip()]
+    if not tags:
+        return
+
+    if os.path.exists(path + ".raw"):
+        shape = tuple(tags[0]['shape'])
+        frames = np.memmap(path + ".raw", dtype=np.uint8, mode="r").reshape((-1,) + shape)
+        for tag in tags:
+            if tag['index'] < len(frames):
+                yield tag, frames[tag['index']]
+    else:
+        video = cv2.VideoCapture(path + ".mp4")
+        for tag in tags:
+            ret, frame = video.read()
+            if not ret:
+                break
+            yield tag, frame
+        video.release()
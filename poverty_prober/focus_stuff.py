@@ -0,0 +1,197 @@
+import math
+import time
+import numpy as np
+
+import json
+from .motion_stuff import fmt
+from .vision_stuff import focus_scores
+from .height_stuff import height_map
+
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+
+class autofocus():
+    """
+    Finds the Z where the camera image is sharpest. A coarse scan of span mm either side of
+    the current height finds the peak to within one step, then golden-section search narrows
+    it to tolerance. Stops early once the score reaches good_enough or time_budget seconds
+    are used up, and always ends parked on the best Z it has seen.
+    Z never goes more than span + approach below the start, and never below the needle
+    floor: clearance above where the needles would touch the leveled wafer (z_drop steps under
+    level_z). If that leaves nothing to search, it refuses to run.
+    """
+    def __init__(self, camera):
+        focus = config.get("focus", {})
+        self.camera = camera
+        self.method = focus.get("method", "laplacian")
+        self.span = float(focus.get("span", 0.1))
+        self.coarse_steps = int(focus.get("coarse steps", 5))
+        self.tolerance = float(focus.get("tolerance", 0.005))
+        self.time_budget = float(focus.get("time budget", 5))
+        # 0 never stops on the score alone
+        self.good_enough = float(focus.get("good enough", 0))
+        self.settle_time = float(focus.get("settle time", 0.05))
+        # every move ends going up, so Z backlash is always taken out the same way
+        self.approach = float(focus.get("approach", 0.02))
+        self.feed = int(focus.get("feed", 200))
+        # how far above touching the needles always stay while focusing
+        self.clearance = float(focus.get("needle clearance", 0.05))
+        self.last_result = None
+
+    def move_to(self, z):
+        prober = self.camera.prober
+        prober.command("G90")
+        if z < prober.current_location()['Z']:
+            prober.command(f"G1 Z{fmt(z - self.approach)} F{self.feed}")
+        prober.command(f"G1 Z{fmt(z)} F{self.feed}")
+        prober.wait_for_idle()
+
+    def needle_floor(self):
+        """Lowest Z focusing may go to here, None before alignment when we don't know where the wafer is"""
+        prober = self.camera.prober
+        if prober.transform is None:
+            return None
+        xyz = prober.current_location()
+        contact = prober.level_z(xyz['X'], xyz['Y'])
+        if self.camera.z_drop:
+            contact -= self.camera.z_drop * 0.04
+        return contact + self.clearance
+
+    def score_at(self, z):
+        self.move_to(z)
+        time.sleep(self.settle_time)
+        pipeline = self.camera.update_camera(after=time.time(), overlay=False)
+        if pipeline is None:
+            return None
+        return pipeline.focus(self.method)
+
+    def run(self, span = None):
+        """
+        Focus here. Returns a dict with the Z it settled on, the score there, how many heights
+        were tried and how long it took, or None if the camera gave no frames.
+        """
+        if self.method not in focus_scores:
+            print(f"unknown focus score {self.method}, have {list(focus_scores)}")
+            return None
+        if span is None:
+            span = self.span
+
+        start_time = time.time()
+        start_z = self.camera.prober.current_location()['Z']
+        low = start_z - span
+        high = start_z + span
+        floor = self.needle_floor()
+        if floor is not None:
+            # every move down overshoots by approach first
+            low = max(low, floor + self.approach)
+            if low >= high:
+                print(f"autofocus refused: the needles would come within {self.clearance} mm of the wafer")
+                return None
+        samples = {}
+
+        def evaluate(z):
+            z = round(min(max(z, low), high), 4)
+            if z not in samples:
+                score = self.score_at(z)
+                if score is None:
+                    raise RuntimeError("no frame from camera")
+                samples[z] = score
+            return samples[z]
+
+        def should_stop():
+            if time.time() - start_time > self.time_budget:
+                return True
+            return self.good_enough > 0 and max(samples.values()) >= self.good_enough
+
+        converged = False
+        try:
+            # coarse, bottom to top
+            step = (high - low)/max(self.coarse_steps - 1, 1)
+            for i in range(self.coarse_steps):
+                evaluate(low + i*step)
+                if should_stop():
+                    break
+
+            if not should_stop():
+                # fine, golden-section inside one coarse step either side of the best so far
+                best = max(samples, key=samples.get)
+                a = max(best - step, low)
+                b = min(best + step, high)
+                ratio = (math.sqrt(5) - 1)/2
+                c = b - ratio*(b - a)
+                d = a + ratio*(b - a)
+                fc = evaluate(c)
+                fd = evaluate(d)
+                while b - a > self.tolerance and not should_stop():
+                    if fc > fd:
+                        b, d, fd = d, c, fc
+                        c = b - ratio*(b - a)
+                        fc = evaluate(c)
+                    else:
+                        a, c, fc = c, d, fd
+                        d = a + ratio*(b - a)
+                        fd = evaluate(d)
+                converged = b - a <= self.tolerance
+        except RuntimeError as e:
+            print(f"autofocus stopped: {e}")
+            if not samples:
+                self.move_to(start_z)
+                return None
+
+        best = max(samples, key=samples.get)
+        score = self.score_at(best)
+        if score is None:
+            score = samples[best]
+        self.last_result = {
+            'Z': best,
+            'score': score,
+            'start Z': start_z,
+            'evaluations': len(samples) + 1,
+            'seconds': time.time() - start_time,
+            'converged': converged,
+        }
+        print(f"focus {self.method} {score:.1f} at Z {best:.4f} after {len(samples) + 1} frames in {self.last_result['seconds']:.1f}s")
+        return self.last_result
+
+
+class focus_map():
+    """
+    Best focus over the wafer, as the level_offset that brought each die into focus, keyed by
+    the die's irl_coordinates. Once min_samples dies are in, the offsets are interpolated over
+    the wafer with a height_map (a plane with three, a thin-plate spline after that), so the
+    rest of the wafer can start at a predicted height.
+    Offsets are relative to the alignment, clear it when the wafer is aligned again.
+    """
+    def __init__(self, min_samples = None):
+        focus = config.get("focus", {})
+        if min_samples is None:
+            min_samples = int(focus.get("map samples", 3))
+        self.min_samples = max(min_samples, 1)
+        self.samples = {}
+        # focus scores are noisy, let the spline miss a die rather than ripple through it
+        self.offsets = height_map(smoothing=float(focus.get("map smoothing", 0.001)))
+
+    def key(self, die_center):
+        return (round(float(die_center[0,0]), 3), round(float(die_center[1,0]), 3))
+
+    def add(self, die_center, offset, score):
+        # focusing the same die again replaces its sample
+        self.samples[self.key(die_center)] = (float(offset), float(score))
+        self.offsets.add(die_center[0,0], die_center[1,0], offset)
+
+    def clear(self):
+        self.samples = {}
+        self.offsets.clear()
+
+    def predict(self, die_center):
+        """level_offset expected to focus the die at die_center, None until min_samples are in"""
+        if len(self.samples) < self.min_samples:
+            return None
+        return self.offsets.z(float(die_center[0,0]), float(die_center[1,0]))
+
+    def expected_score(self):
+        # typical in focus score on this wafer, what a predicted height has to come close to
+        if not self.samples:
+            return None
+        return float(np.median([sample[1] for sample in self.samples.values()]))
@@ -2,8 +2,10 @@ from PySide6.QtWidgets import QWidget, QDialog,QHBoxLayout, QGraphicsTextItem, Q
 from .probeGUI import Ui_MainWindow
 from .probing_stuff import probe_handler
 from .camera_stuff import camera_handler
+from .serial_stuff import serial_handler, port_watcher
+from .motion_stuff import estimate_job
 from PySide6.QtGui import QBrush, QColor, QCursor, QPen
-from PySide6.QtCore import QRectF, Qt
+from PySide6.QtCore import QRectF, Qt, QObject, Signal
 import numpy as np
 import gdspy
 import math
@@ -12,8 +14,6 @@ from .wafer_visualizer import WaferVisualizer
 
 from pathlib import Path
 
-import serial
-import serial.tools.list_ports
 import time
 import pygame
 
@@ -334,63 +334,9 @@ class wafer_chip(QGraphicsRectItem):
     def set_irl_coords(self, x, y):
         self.irl_coordinates = np.array([[x],[y]])
 
-class serial_handler():
-    def __init__(self):
-        self.ser = None
-        self.ser_name = None
-
-
-    def list_serial_ports(self):
-        ports = list(serial.tools.list_ports.comports())
-        ports = [port for port in ports if "Bluetooth" not in str(port)]
-        return [str(port.device) for port in ports]
-    
-    def connect_serial_port(self, port):
-        try:
-            if self.ser!=None:
-                self.ser.close()
-            self.ser = serial.Serial(port, 115200, timeout=1)
-            time.sleep(2)
-
-
-        except serial.SerialException as e:
-            return False
-
-        finally:
-            if self.ser!=None and self.ser.is_open:
-                self.ser_name = port
-                return True
-            
-    def check_serial(self):
-        if self.ser is not None:
-      
-            ports = self.list_serial_ports()
-            yeet = False
-            for port in ports:
-                if self.ser_name == port:
-                    yeet = True
-            
-            if yeet is False:
-                self.ser.close()
-
-            return yeet
-        
-    def write(self, message):
-        self.ser.write(message.encode())
-        self.ser.flush()
-
-    def flush(self):
-        self.ser.flush()
-        self.ser.reset_input_buffer()
-
-    def read(self):
-        return self.ser.readline().decode().strip()
-
-    def char_read(self):
-        return self.ser.read(1).decode()
-
-    def in_waiting(self):
-        return self.ser.in_waiting
+class port_signal(QObject):
+    # the watcher lives on its own thread, a queued signal hands the port list to the GUI thread
+    changed = Signal(list)
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -411,6 +357,9 @@ class MainWindow(QMainWindow):
         self.probe_handler = probe_handler(self.ser)
 
         self.camera = camera_handler(self.probe_handler, self)
+        if self.camera.headless:
+            # no OpenCV window to catch ESC, take it straight from the keyboard
+            keyboard.add_hotkey("esc", self.camera.cancel)
 
        
 
@@ -439,6 +388,9 @@ class MainWindow(QMainWindow):
         self.ui.set_align_1.clicked.connect(self.align_1)
         self.ui.set_align_2.clicked.connect(self.align_2)
         self.ui.confirm_align.clicked.connect(self.apply_transformation)
+        self.ui.add_align.clicked.connect(self.add_alignment_mark)
+        self.ui.add_height.clicked.connect(self.add_height_sample)
+        self.ui.clear_align.clicked.connect(self.clear_alignment_marks)
 
         self.ui.wafer_create.clicked.connect(self.create_wafer)
         self.ui.add_new_chip_type.clicked.connect(self.create_chip_type)
@@ -448,6 +400,7 @@ class MainWindow(QMainWindow):
         
         self.ui.probe_individual.clicked.connect(self.probe_single_chip)
         self.ui.Set_drop_height.clicked.connect(self.drop_test)
+        self.ui.calibrate_backlash.clicked.connect(self.calibrate_backlash)
         self.ui.export_2.clicked.connect(self.export)
         
         self.ui.see_resistance.clicked.connect(self.check_single_chip)
@@ -458,6 +411,11 @@ class MainWindow(QMainWindow):
         # self.ui.transformed_move.clicked.connect(self.manual_move)
         self.ui.visualize_wafer.clicked.connect(self.visualize_all)
 
+        self.port_signal = port_signal()
+        self.port_signal.changed.connect(self.ports_changed)
+        self.port_watcher = port_watcher(self.ser, self.port_signal.changed.emit)
+        self.port_watcher.start()
+
 
     def connect_meter(self):
         if self.ui.MultimeterAddress.text() != None:
@@ -496,9 +454,18 @@ class MainWindow(QMainWindow):
     def camera_set(self):
         self.show_camera = not self.show_camera
 
-    def list_serial_ports(self):
+    def list_serial_ports(self, ports = None):
+        if ports is None:
+            ports = self.ser.list_serial_ports()
+        selected = self.ui.ser_dropdown.currentText()
         self.ui.ser_dropdown.clear()
-        self.ui.ser_dropdown.addItems(self.ser.list_serial_ports())
+        self.ui.ser_dropdown.addItems(ports)
+        if selected in ports:
+            self.ui.ser_dropdown.setCurrentText(selected)
+
+    def ports_changed(self, ports):
+        self.list_serial_ports(ports)
+        self.check_serial(ports)
 
     def connect_serial_port(self):
         selected_text = str(self.ui.ser_dropdown.currentText())
@@ -510,6 +477,9 @@ class MainWindow(QMainWindow):
             self.ui.label.setText("Connected:")
             msg.exec()
             self.connected = True
+            # job estimates use the printer's own limits, before homing so we don't wait on it
+            if not self.probe_handler.motion.load_from_printer(self.ser):
+                print("could not read M503, job estimates use the config.json kinematics")
             self.homing()
 
         else:
@@ -519,8 +489,8 @@ class MainWindow(QMainWindow):
             self.ui.label.setText("COM PORTS: ")
             msg.exec()
 
-    def check_serial(self):
-        if self.ser.check_serial() is False:
+    def check_serial(self, ports = None):
+        if self.ser.check_serial(ports) is False:
             self.connected = False
             self.ui.label.setText("COM PORT: ")  
 
@@ -621,6 +591,15 @@ class MainWindow(QMainWindow):
     def align_2(self):
         self.camera.align_2()
 
+    def add_alignment_mark(self):
+        self.camera.add_alignment_mark()
+
+    def clear_alignment_marks(self):
+        self.camera.clear_alignment_marks()
+
+    def add_height_sample(self):
+        self.camera.add_height_sample()
+
     def apply_transformation(self):
         self.camera.apply_transformation()
 
@@ -1040,6 +1019,19 @@ class MainWindow(QMainWindow):
                 # Scale the coordinates
                 filtered_probe_path[:2,:] = filtered_probe_path[:2,:] / 1000
 
+                if self.camera.aligned and self.camera.z_drop:
+                    die_centers = [item.irl_coordinates for item in self.ui.graphicsView.scene().items()
+                                   if isinstance(item, wafer_chip) and item.chip_type == self.selected_type.id]
+                    overhead = self.camera.settle_time + float(config["probing"]["meter read time"])
+                    runtime = estimate_job(self.probe_handler.motion, self.probe_handler, die_centers,
+                                           self.sort_probe_path(filtered_probe_path), self.camera.z_drop, overhead)
+                    if self.camera.camera_correction:
+                        # plot_die looks at the camera and checks the position at every point, none of that is modelled
+                        print(f"estimated probing time: at least {runtime/60:.1f} min for {len(die_centers)} dies "
+                              f"(compiled path only, camera correction is on and adds frame waits and position checks per point)")
+                    else:
+                        print(f"estimated probing time: {runtime/60:.1f} min for {len(die_centers)} dies")
+
                 for item in self.ui.graphicsView.scene().items():
                     if isinstance(item, wafer_chip):
                         if item.chip_type == self.selected_type.id:
@@ -1094,6 +1086,21 @@ class MainWindow(QMainWindow):
 
         return sorted
 
+    def calibrate_backlash(self):
+        axis, ok = QInputDialog.getItem(None, "Calibrate backlash", "axis:", ["X", "Y"], 0, False)
+        if not ok:
+            return
+        text, ok = QInputDialog.getText(None, "Calibrate backlash",
+                                        f"machine {axis} positions in mm, comma separated (empty for here):")
+        if not ok:
+            return
+        try:
+            positions = [float(value) for value in text.split(",") if value.strip()] or None
+        except ValueError:
+            print(f"could not read positions {text}")
+            return
+        self.camera.calibrate_backlash(axis, positions)
+
     def drop_test(self):
         self.camera.set_drop_dist()
 
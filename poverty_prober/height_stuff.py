@@ -0,0 +1,163 @@
+import math
+import numpy as np
+
+import json
+
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+
+class height_map():
+    """
+    Z over the chuck from any number of (x, y, z) samples, interpolated for any x, y.
+    method "plane" is a least squares plane, "spline" a thin-plate spline that bends through
+    every sample (smoothing > 0 lets it miss noisy ones), which follows chuck warp and tilt in
+    Y that a plane through two marks never saw. With grid step > 0 the spline is baked onto a
+    grid over the samples once and looked up bilinearly, outside it the spline is used as is.
+    Samples that only spread along one direction give a line along that direction and no slope
+    across it, samples closer together than min spread give their flat mean Z.
+    """
+    def __init__(self, method = None, smoothing = None, grid_step = None):
+        leveling = config.get("leveling", {})
+        self.method = method if method is not None else leveling.get("method", "spline")
+        self.smoothing = float(smoothing if smoothing is not None else leveling.get("smoothing", 0))
+        self.grid_step = float(grid_step if grid_step is not None else leveling.get("grid step", 0))
+        # a slope is only fitted along directions the samples cover by at least this much, mm
+        self.min_spread = float(leveling.get("min spread", 1.0))
+        self.samples = {}
+        self.fitted = False
+        # z = m*x + m_y*y + b, the whole fit for a plane and the affine part of a spline
+        self.plane = (0.0, 0.0, 0.0)
+        self.centers = None
+        self.weights = None
+        self.grid = None
+
+    def key(self, x, y):
+        return (round(float(x), 3), round(float(y), 3))
+
+    def add(self, x, y, z):
+        # sampling the same spot again replaces it
+        self.samples[self.key(x, y)] = float(z)
+        self.fitted = False
+
+    def clear(self):
+        self.samples = {}
+        self.fitted = False
+
+    def __len__(self):
+        return len(self.samples)
+
+    def fit(self):
+        self.centers = None
+        self.weights = None
+        self.grid = None
+        self.fitted = True
+        if not self.samples:
+            self.plane = (0.0, 0.0, 0.0)
+            return
+        points = np.array(list(self.samples.keys()))
+        z = np.array(list(self.samples.values()))
+        x, y = points[:, 0], points[:, 1]
+        ones = np.ones(len(z))
+
+        # how far the samples reach along their main direction and across it
+        mean = points.mean(axis=0)
+        directions = np.linalg.svd(points - mean, full_matrices=False)[2]
+        along = (points - mean) @ directions[0]
+        across = (points - mean) @ directions[-1] if len(directions) > 1 else np.zeros(len(z))
+
+        if np.ptp(along) < self.min_spread:
+            if len(z) > 1:
+                print(f"height samples span less than {self.min_spread} mm, leveling flat at their mean Z")
+            self.plane = (0.0, 0.0, float(z.mean()))
+            return
+        if np.ptp(across) < self.min_spread:
+            # a line along the samples, flat across it, whichever way they happen to lie
+            slope, offset = np.linalg.lstsq(np.column_stack((along, ones)), z, rcond=None)[0]
+            m, m_y = slope*directions[0]
+            self.plane = (float(m), float(m_y), float(offset - slope*(mean @ directions[0])))
+            return
+        if self.method != "spline" or len(z) == 3:
+            m, m_y, b = np.linalg.lstsq(np.column_stack((x, y, ones)), z, rcond=None)[0]
+            self.plane = (float(m), float(m_y), float(b))
+            return
+
+        # [K + smoothing*I, P; P^T, 0] [w; a] = [z; 0], a is the plane part
+        count = len(z)
+        system = np.zeros((count + 3, count + 3))
+        system[:count, :count] = self.kernel(np.hypot(x[:, None] - x, y[:, None] - y)) + self.smoothing*np.eye(count)
+        system[:count, count:] = np.column_stack((ones, x, y))
+        system[count:, :count] = system[:count, count:].T
+        solution = np.linalg.lstsq(system, np.concatenate((z, np.zeros(3))), rcond=None)[0]
+        self.centers = points
+        self.weights = solution[:count]
+        self.plane = (float(solution[count + 1]), float(solution[count + 2]), float(solution[count]))
+
+        if self.grid_step > 0:
+            self.bake(x.min(), x.max(), y.min(), y.max())
+
+    def kernel(self, r):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(r > 0, r*r*np.log(r), 0.0)
+
+    def spline(self, x, y):
+        m, m_y, b = self.plane
+        z = m*x + m_y*y + b
+        if self.centers is not None:
+            # a few million distances at a time, a fine grid over many samples would not fit in memory
+            chunk = max(1, (1 << 22)//len(self.centers))
+            z = np.array(z, dtype=np.float64)
+            for start in range(0, len(x), chunk):
+                r = np.hypot(x[start:start + chunk, None] - self.centers[:, 0],
+                             y[start:start + chunk, None] - self.centers[:, 1])
+                z[start:start + chunk] += self.kernel(r) @ self.weights
+        return z
+
+    def bake(self, x0, x1, y0, y1):
+        # one step of margin so a die at the edge of the samples still reads from the grid
+        step = self.grid_step
+        columns = min(int(math.ceil((x1 - x0)/step)) + 3, 1024)
+        rows = min(int(math.ceil((y1 - y0)/step)) + 3, 1024)
+        gx = x0 - step + np.arange(columns)*step
+        gy = y0 - step + np.arange(rows)*step
+        xx, yy = np.meshgrid(gx, gy)
+        self.grid = (gx[0], gy[0], self.spline(xx.ravel(), yy.ravel()).reshape(rows, columns))
+
+    def z(self, x, y):
+        """Interpolated Z at x, y, scalars or arrays of the same shape"""
+        if not self.fitted:
+            self.fit()
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        shape = np.broadcast(x, y).shape
+        x, y = np.broadcast_arrays(x, y)
+        x = x.ravel()
+        y = y.ravel()
+
+        if self.grid is None:
+            z = self.spline(x, y)
+        else:
+            x0, y0, values = self.grid
+            rows, columns = values.shape
+            fx = (x - x0)/self.grid_step
+            fy = (y - y0)/self.grid_step
+            inside = (fx >= 0) & (fx <= columns - 1) & (fy >= 0) & (fy <= rows - 1)
+            i = np.clip(np.floor(fx).astype(int), 0, columns - 2)
+            j = np.clip(np.floor(fy).astype(int), 0, rows - 2)
+            tx = fx - i
+            ty = fy - j
+            z = ((values[j, i]*(1 - tx) + values[j, i + 1]*tx)*(1 - ty)
+                 + (values[j + 1, i]*(1 - tx) + values[j + 1, i + 1]*tx)*ty)
+            if not inside.all():
+                z[~inside] = self.spline(x[~inside], y[~inside])
+
+        if shape == ():
+            return float(z[0])
+        return z.reshape(shape)
+
+    def residuals(self):
+        # map minus sample, in the order the samples went in
+        if not self.samples:
+            return []
+        points = np.array(list(self.samples.keys()))
+        return list(self.z(points[:, 0], points[:, 1]) - np.array(list(self.samples.values())))
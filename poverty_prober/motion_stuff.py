@@ -0,0 +1,294 @@
+import math
+
+
+class probe_plan():
+    """
+    One die worth of gcode. measure_points holds (index of the M400 line, index of the
+    probe point) for every spot where the needles are down and the meter has to be read.
+    point_starts holds the first line of every probe point so an aborted run can finish
+    lifting the needles before it stops. backlash holds, by the index of each XY move, the
+    backlash direction state the prober is in once that move has been sent.
+    """
+    def __init__(self):
+        self.lines = []
+        self.measure_points = []
+        self.point_starts = []
+        self.backlash = {}
+        # commanded X, Y, Z and backlash state once the plan has run, where the next die starts from
+        self.end = None
+        self.end_backlash = None
+        # set by run_plan when the printer stopped answering part way through
+        self.error = None
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def start_point(self):
+        self.point_starts.append(len(self.lines))
+
+    def move(self, line, backlash):
+        self.backlash[len(self.lines)] = backlash
+        self.lines.append(line)
+
+    def sync(self, point_index):
+        self.measure_points.append((len(self.lines), point_index))
+        self.lines.append("M400")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def fmt(value):
+    # Marlin does not read exponents, so never let str() turn a small move into 1e-05
+    return f"{value:.4f}"
+
+
+def compile_die_plan(prober, points_to_probe, die_center, z_drop, feed = 200, start = None, backlash = None):
+    """
+    Turn a sorted probe path (die coordinates in mm) into one gcode block for the aligned stage.
+    start is where the stage will be when the plan runs, the current location if None, and
+    backlash the direction state it will be in, the prober's if None. The prober is left as is.
+    """
+    plan = probe_plan()
+    drop = z_drop * 0.04
+
+    # simulate the position model so the backlash direction flags come out like abs_move would leave them
+    xyz = dict(prober.current_location() if start is None else start)
+
+    # the whole die in machine space at once, leveled like abs_move(level=True) would
+    machine = prober.transform.probe_path(points_to_probe, die_center, prober.level_offset)
+
+    # backlash_target moves the prober's direction flags, compile against a copy and let
+    # run_plan hand each point's flags over once its move has really gone out
+    directions = backlash_state(prober)
+    if backlash is not None:
+        set_backlash_state(prober, backlash)
+    try:
+        for i in range(points_to_probe.shape[1]):
+            x, y, z = machine[:, i]
+            target_x, target_y = prober.backlash_target(x, y, xyz)
+
+            plan.start_point()
+            plan.add("G90")
+            plan.add(f"G1 Z{fmt(z)} F200")
+            plan.move(f"G1 X{fmt(target_x)} Y{fmt(target_y)} F{feed}", backlash_state(prober))
+            plan.add("G91")
+            plan.add(f"G1 Z{fmt(-drop)} F200")
+            plan.add("G1 E15 F800")
+            plan.sync(i)
+            plan.add("G1 E-15 F800")
+            plan.add(f"G1 Z{fmt(drop)} F200")
+
+            xyz = {'X': target_x, 'Y': target_y, 'Z': z}
+        plan.end_backlash = backlash_state(prober)
+    finally:
+        set_backlash_state(prober, directions)
+
+    plan.end = xyz
+    return plan
+
+
+def backlash_state(prober):
+    return prober.x_direction, prober.y_direction, dict(prober.applied_backlash)
+
+
+def set_backlash_state(prober, state):
+    prober.x_direction, prober.y_direction, applied = state
+    prober.applied_backlash = dict(applied)
+
+
+def run_plan(prober, plan):
+    """
+    Stream a compiled plan, yielding the probe point index every time the needles are down
+    and the printer has finished moving. Closing the generator early still sends the rest of
+    the current point (measuring off, needles up) before stopping. If the printer stops
+    answering the same happens, the generator ends and plan.error says why.
+    """
+    def send(first, last):
+        done = None
+        for index in range(first, last):
+            if index in plan.backlash:
+                # the prober's direction flags follow the moves that actually went out
+                set_backlash_state(prober, plan.backlash[index])
+            done = prober.command(plan.lines[index])
+        return done
+
+    start = 0
+    try:
+        for line_index, point_index in plan.measure_points:
+            send(start, line_index)
+            # lines behind the M400 stay unsent, so the needles can't leave before we measure
+            done = send(line_index, line_index + 1)
+            start = line_index + 1
+            prober.ser.wait_for(done)
+            yield point_index
+
+        send(start, len(plan.lines))
+        start = len(plan.lines)
+    except (TimeoutError, ConnectionError) as e:
+        print(f"probe plan stopped: {e}")
+        plan.error = str(e)
+    finally:
+        if start < len(plan.lines):
+            stop = len(plan.lines)
+            for point_start in plan.point_starts:
+                if point_start >= start:
+                    stop = point_start
+                    break
+            send(start, stop)
+
+
+class motion_model():
+    """
+    Trapezoidal move timing for a Marlin style planner. Every move is assumed to start and
+    end at the jerk limited safe speed, which is what Marlin falls back to between moves that
+    are separated by an M400 or a direction change, so estimates lean slightly long.
+    Speeds are in mm/s and accelerations in mm/s^2, the same units M503 reports.
+    """
+    def __init__(self, kinematics = None):
+        if kinematics is None:
+            kinematics = {}
+        axes = ['X', 'Y', 'Z', 'E']
+        self.max_feedrate = {axis: float(kinematics.get(f"max feedrate {axis}", default))
+                             for axis, default in zip(axes, [200, 200, 12, 120])}
+        self.max_acceleration = {axis: float(kinematics.get(f"max acceleration {axis}", default))
+                                 for axis, default in zip(axes, [1000, 1000, 200, 5000])}
+        self.jerk = {axis: float(kinematics.get(f"jerk {axis}", default))
+                     for axis, default in zip(axes, [8, 8, 0.4, 4.5])}
+        self.steps_per_mm = {axis: float(kinematics.get(f"steps per mm {axis}", default))
+                             for axis, default in zip(axes, [80, 80, 400, 93])}
+        self.acceleration = float(kinematics.get("acceleration", 1250))
+        self.homing_time = float(kinematics.get("homing time", 20))
+
+    def read_m503(self, lines):
+        # lines look like "echo:  M203 X200.00 Y200.00 Z12.00 E120.00"
+        for line in lines:
+            words = line.replace("echo:", "").split()
+            if not words:
+                continue
+            code = words[0]
+            values = {}
+            for word in words[1:]:
+                try:
+                    values[word[0]] = float(word[1:])
+                except ValueError:
+                    continue
+            if code == "M92":
+                for axis in self.steps_per_mm:
+                    self.steps_per_mm[axis] = values.get(axis, self.steps_per_mm[axis])
+            elif code == "M201":
+                for axis in self.max_acceleration:
+                    self.max_acceleration[axis] = values.get(axis, self.max_acceleration[axis])
+            elif code == "M203":
+                for axis in self.max_feedrate:
+                    self.max_feedrate[axis] = values.get(axis, self.max_feedrate[axis])
+            elif code == "M204":
+                self.acceleration = values.get('P', values.get('S', self.acceleration))
+            elif code == "M205":
+                for axis in self.jerk:
+                    self.jerk[axis] = values.get(axis, self.jerk[axis])
+
+    def load_from_printer(self, ser):
+        responses = ser.query("M503")
+        if responses is None:
+            return False
+        self.read_m503(responses)
+        return True
+
+    def move_time(self, delta, feed):
+        """Seconds for one move, delta is {axis: mm}, feed in mm/min like gcode F"""
+        moving = {axis: abs(delta.get(axis, 0)) for axis in ['X', 'Y', 'Z', 'E']}
+        # E only counts toward the length when nothing else moves, same as Marlin
+        distance = math.sqrt(moving['X']**2 + moving['Y']**2 + moving['Z']**2)
+        if distance == 0:
+            distance = moving['E']
+        if distance == 0:
+            return 0.0
+
+        speed = feed/60.0
+        acceleration = self.acceleration
+        start_speed = speed
+        for axis, travel in moving.items():
+            if travel == 0:
+                continue
+            share = travel/distance
+            speed = min(speed, self.max_feedrate[axis]/share)
+            acceleration = min(acceleration, self.max_acceleration[axis]/share)
+            start_speed = min(start_speed, self.jerk[axis]/share)
+        start_speed = min(start_speed, speed)
+
+        ramp_distance = (speed**2 - start_speed**2)/(2*acceleration)
+        if 2*ramp_distance >= distance:
+            # never reaches cruise speed, triangle profile
+            peak = math.sqrt(acceleration*distance + start_speed**2)
+            return 2*(peak - start_speed)/acceleration
+        return 2*(speed - start_speed)/acceleration + (distance - 2*ramp_distance)/speed
+
+    def rel_move_time(self, x, y, z = None, feed = None):
+        if feed is None:
+            feed = 200
+        return self.move_time({'X': x, 'Y': y, 'Z': z or 0}, feed)
+
+    def abs_move_time(self, start, x, y, z = None, feed = None):
+        if feed is None:
+            feed = 200
+        delta = {'X': x - start['X'], 'Y': y - start['Y']}
+        if z is not None:
+            delta['Z'] = z - start['Z']
+        return self.move_time(delta, feed)
+
+    def gcode_time(self, lines, start = None):
+        """Walk a list of gcode lines the way the printer would and add up the move times"""
+        xyz = {'X': 0, 'Y': 0, 'Z': 0, 'E': 0}
+        if start is not None:
+            xyz.update(start)
+        relative = False
+        feed = 200
+        total = 0.0
+        for line in lines:
+            words = line.split(';')[0].split()
+            if not words:
+                continue
+            code = words[0].upper()
+            if code == "G90":
+                relative = False
+            elif code == "G91":
+                relative = True
+            elif code == "G28":
+                total += self.homing_time
+            elif code in ("G0", "G1"):
+                delta = {}
+                for word in words[1:]:
+                    axis = word[0].upper()
+                    value = float(word[1:])
+                    if axis == 'F':
+                        feed = value
+                    elif axis in xyz:
+                        target = xyz[axis] + value if relative else value
+                        delta[axis] = target - xyz[axis]
+                        xyz[axis] = target
+                total += self.move_time(delta, feed)
+        return total
+
+    def plan_time(self, plan, start = None):
+        return self.gcode_time(plan.lines, start)
+
+
+def estimate_job(model, prober, die_centers, points_to_probe, z_drop, point_overhead = 0):
+    """
+    Seconds to probe points_to_probe on every die in die_centers, compiled the same way
+    probe_compiled streams them. point_overhead covers settling and reading the meter. The
+    camera corrected plot_die path takes longer, this is a lower bound for it.
+    """
+    start = dict(prober.current_location())
+    backlash = None
+    total = 0.0
+    for die_center in die_centers:
+        # backlash for the first move of a die depends on where the last one left off
+        plan = compile_die_plan(prober, points_to_probe, die_center, z_drop, start=start, backlash=backlash)
+        total += model.plan_time(plan, start)
+        total += points_to_probe.shape[1]*point_overhead
+        if plan.end is not None:
+            start = dict(plan.end)
+            backlash = plan.end_backlash
+    return total
@@ -65,13 +65,17 @@ class Ui_MainWindow(object):
 
 3. You will see an outline. If you are satisfied with it, hit enter to continue. Otherwise, hit esc to leave.
 
-3. Do the same steps for the second alignment mark
+3. Do the same steps for the second alignment mark. More marks can be added with Add Alignment Mark, every mark goes into a least squares fit. Setting mark 1 or 2 again, confirming or Clear Extra Marks drops the extra ones
 
 4. Hit confirm alignment to lock in your settings
 
 5. Manually drop your probes, and count the number of steps.
 
-6. Hit the set Z-drop height button. In the prompt, enter the number of steps you counted """,
+6. Hit the set Z-drop height button. In the prompt, enter the number of steps you counted
+
+7. Optional: focus on the wafer anywhere else and hit Add Height Sample, Z between samples is interpolated so a smaller drop height is safe
+
+8. Optional: hit Calibrate Backlash, pick an axis and enter machine positions (or nothing to measure where you are). It needs an alignment mark set, the result is saved to backlash.json """,
             
             "wafer_shape": """This visual grid represents your wafer layout:
 
@@ -215,13 +219,21 @@ class Ui_MainWindow(object):
         self.set_align_1 = QPushButton("Set Alignment Mark 1")
         self.set_align_2 = QPushButton("Set Alignment Mark 2")
         self.confirm_align = QPushButton("Confirm Alignment")
+        self.add_align = QPushButton("Add Alignment Mark")
+        self.add_height = QPushButton("Add Height Sample")
         self.Set_drop_height = QPushButton("Set Probe Drop Height")
+        self.calibrate_backlash = QPushButton("Calibrate Backlash")
+        self.clear_align = QPushButton("Clear Extra Marks")
         
         alignment_layout.addLayout(alignment_header_layout, 0, 0, 1, 3)
         alignment_layout.addWidget(self.set_align_1, 1, 0, 1, 1)
         alignment_layout.addWidget(self.set_align_2, 1, 1, 1, 1)
         alignment_layout.addWidget(self.confirm_align, 1, 2, 1, 1)
-        alignment_layout.addWidget(self.Set_drop_height, 2, 0, 1, 3)
+        alignment_layout.addWidget(self.add_align, 2, 0, 1, 1)
+        alignment_layout.addWidget(self.add_height, 2, 1, 1, 1)
+        alignment_layout.addWidget(self.Set_drop_height, 2, 2, 1, 1)
+        alignment_layout.addWidget(self.clear_align, 3, 0, 1, 1)
+        alignment_layout.addWidget(self.calibrate_backlash, 3, 1, 1, 2)
         
         main_layout.addWidget(alignment_group)
 
@@ -1,13 +1,41 @@
-import time
 import numpy as np
 import math
 
 import json
+from .motion_stuff import motion_model, fmt
+from .height_stuff import height_map
 
 with open("config.json", "r") as f:
     config = json.load(f)
 
 
+class wafer_transform():
+    """
+    Wafer mm to machine mm as fitted by probe_handler.fit_alignment, built once per alignment.
+    Works on whole 2xN arrays, so a die's probe path or every junction on the wafer maps to
+    machine XYZ in one call. Z comes from the height map, level_offset on top is the caller's.
+    """
+    def __init__(self, matrix, displacement, heights):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.displacement = np.asarray(displacement, dtype=np.float64).reshape(2, 1)
+        self.heights = heights
+
+    def xy(self, points):
+        return self.matrix @ points + self.displacement
+
+    def z(self, x, y):
+        return self.heights.z(x, y)
+
+    def xyz(self, points, level_offset = 0.0):
+        """3xN machine X, Y and leveled Z for 2xN wafer points"""
+        machine = self.xy(points)
+        return np.vstack((machine, self.z(machine[0], machine[1]) + level_offset))
+
+    def probe_path(self, points_to_probe, die_center, level_offset = 0.0):
+        # points_to_probe is relative to the die, extra rows (like the layer) are ignored
+        return self.xyz(np.asarray(points_to_probe, dtype=np.float64)[:2] + die_center, level_offset)
+
+
 class probe_handler():
     def __init__(self, ser):
         self.ser = ser
@@ -21,17 +49,44 @@ class probe_handler():
         self.scaling = None
         self.rotation = None
         self.displacement = None
+        # wafer to machine, machine = matrix @ wafer + displacement
+        self.matrix = None
+        self.transform = None
+        self.alignment_residuals = []
 
         self.z1 = None
         self.z2 = None
         self.m = None
+        self.m_y = 0.0
         self.b = None
+        # machine Z over the chuck, from the alignment marks and any height samples after
+        self.heights = height_map()
+        # added to every leveled Z, autofocus moves it when the wafer sits off the alignment line
+        self.level_offset = 0.0
 
+        # commanded machine position, kept up to date from every move we send
         self.xyz = {'X':0, 'Y' :0, 'Z':0}
+        self.relative = False
+        self.position_known = False
+        self.moves_since_sync = 0
+        self.reconcile_every = int(config["printer defaults"].get("reconcile every", 0))
         self.x_direction = 'right'
         self.y_direction = 'up'
         self.x_backlash = 0.03
         self.y_backlash = 0.03
+        # per axis list of (start, end, backlash) bands, filled by camera_handler.calibrate_backlash
+        self.backlash_table = {'X': [], 'Y': []}
+        self.applied_backlash = {'X': 0, 'Y': 0}
+        self.backlash_deadband = float(config["printer defaults"].get("backlash deadband", 0.0001))
+        self.backlash_path = config["printer defaults"].get("backlash table", "backlash.json")
+        self.load_backlash_table()
+
+        self.correction_tolerance = float(config["printer defaults"].get("correction tolerance", 0.01))
+        self.correction_iterations = int(config["printer defaults"].get("correction iterations", 2))
+        self.last_move_error = {'X': 0, 'Y': 0}
+
+        # kinematics from config.json, motion.load_from_printer(ser) swaps in the M503 values
+        self.motion = motion_model(config.get("kinematics"))
 
 
 
@@ -55,190 +110,345 @@ class probe_handler():
         return xyz
 
     def find_location(self):
-        self.ser.flush()
-
-        self.ser.write("M114\r\n")
-
-        self.ser.flush()
+        xyz = self.read_position()
+        if xyz is None:
+            return self.xyz
+        return xyz
 
-        time.sleep(0.1)
+    def read_position(self):
+        # query waits for everything queued before M114 to be acknowledged first, None if the printer never says
+        responses = self.ser.query("M114")
+        if responses is None:
+            print("printer did not answer M114")
+            return None
 
-        while True:
-            line = self.ser.read()
-            if line and 'X:' in line and 'Y:' in line and 'Z:' in line:
+        for line in responses:
+            if 'X:' in line and 'Y:' in line and 'Z:' in line:
                 print(line)
                 self.xyz = self.extract_xyz(line)
+                self.position_known = True
+                self.moves_since_sync = 0
                 return self.xyz
+        return None
+
+    def measure_position(self):
+        """
+        Where the steppers actually are once the stage has stopped, from the Count part of M114.
+        The X:/Y: part is only the commanded position and says nothing about how the move went.
+        None when the printer did not answer or does not report step counts.
+        """
+        if not self.wait_for_idle():
+            return None
+        responses = self.ser.query("M114")
+        if responses is None:
+            print("printer did not answer M114")
+            return None
+        for line in responses:
+            if "Count" not in line:
+                continue
+            steps = self.extract_xyz(line.split("Count", 1)[1])
+            if 'X' in steps and 'Y' in steps:
+                return {axis: steps[axis]/self.motion.steps_per_mm[axis] for axis in steps}
+        print("printer did not report step counts, not correcting")
+        return None
+
+    def current_location(self):
+        # only ask the printer when we lost track (homing) or the reconcile interval is up
+        if not self.position_known:
+            return self.find_location()
+        if self.reconcile_every > 0 and self.moves_since_sync >= self.reconcile_every:
+            return self.find_location()
+        return self.xyz
+
+    def command(self, line):
+        self.track_command(line)
+        return self.ser.send(line)
+
+    def track_command(self, line):
+        words = line.split()
+        if not words:
+            return
+        code = words[0].upper()
+        if code == "G90":
+            self.relative = False
+        elif code == "G91":
+            self.relative = True
+        elif code == "G28":
+            self.position_known = False
+        elif code in ("G0", "G1"):
+            for word in words[1:]:
+                axis = word[0].upper()
+                if axis in self.xyz and len(word) > 1:
+                    value = float(word[1:])
+                    if self.relative:
+                        self.xyz[axis] = self.xyz[axis] + value
+                    else:
+                        self.xyz[axis] = value
+            self.moves_since_sync += 1
 
     def pause(self):
-        self.ser.flush()
-        self.ser.write("M0\r\n")
+        self.command("M0")
 
 
     def homing(self):
-        self.ser.flush()
-        time.sleep(0.5)
-
-        self.ser.write("G21\r\n")
-        time.sleep(0.1)
-        self.ser.write("G17\r\n")
-        time.sleep(0.1)
-        self.ser.write(f"{config["printer defaults"]["homing"]}\r\n")
-        # self.gcode_waiting()
-        time.sleep(0.1)
-        self.ser.write("M302 S0 \r\n")
-        time.sleep(0.1)
-        self.ser.write("G0 E-10 \r\n")
-        time.sleep(0.1)
-        self.ser.write("M221 800 \r\n")
+        self.command("G21")
+        self.command("G17")
+        self.command(config["printer defaults"]["homing"])
+        self.command("M302 S0")
+        self.command("G0 E-10")
+        self.command("M221 800")
 
     def turn_off_measuring(self):
-        self.ser.write("G1 E-15 F800\r\n")
+        self.command("G1 E-15 F800")
 
 
     def turn_on_measuring(self):
-        self.ser.write("G1 E15 F800\r\n")
+        self.command("G1 E15 F800")
 
 
     def rel_move(self, x, y, z = None, feed = None):
 
-        self.ser.write("G91\r\n")
-        cmd = "X" + str(x) + " " + "Y" + str(y)
+        self.command("G91")
+        cmd = "X" + fmt(x) + " " + "Y" + fmt(y)
         if z is not None:
-            cmd = cmd + " Z" + str(z)
+            cmd = cmd + " Z" + fmt(z)
         if feed is None:
             cmd = cmd + " F" + str(200)
         else:
             cmd = cmd + " F" + str(feed)
-        self.ser.write("G1 " + cmd + "\r\n")
+        self.command("G1 " + cmd)
+
+    def backlash_for(self, axis, position):
+        # calibrated bands win, otherwise the single per-axis value
+        for band_start, band_end, backlash in self.backlash_table[axis]:
+            if band_start <= position < band_end:
+                return backlash
+        if axis == 'X':
+            return self.x_backlash
+        return self.y_backlash
+
+    def backlash_offset(self, axis):
+        # how far the machine coordinate sits from the stage once the slack is taken up going this way
+        return self.applied_backlash[axis]
+
+    def backlash_target(self, x, y, xyz):
+        # Backlash correction: flip the direction flag when the move reverses, the
+        # machine target then picks up the offset for the new direction and position
+        stage_dx = x - (xyz["X"] - self.backlash_offset('X'))
+        stage_dy = y - (xyz["Y"] - self.backlash_offset('Y'))
+        # moves shorter than the deadband are rounding from the alignment, not a reversal
+        if stage_dx < -self.backlash_deadband:
+            self.x_direction = 'left'
+        elif stage_dx > self.backlash_deadband:
+            self.x_direction = 'right'
+
+        if stage_dy < -self.backlash_deadband:
+            self.y_direction = 'down'
+        elif stage_dy > self.backlash_deadband:
+            self.y_direction = 'up'
+
+        self.applied_backlash['X'] = -self.backlash_for('X', x) if self.x_direction == 'left' else 0
+        self.applied_backlash['Y'] = -self.backlash_for('Y', y) if self.y_direction == 'down' else 0
+        return x + self.backlash_offset('X'), y + self.backlash_offset('Y')
+
+    def reset_backlash_direction(self, axis):
+        # the last move on axis went up, the slack is taken up that way and machine and stage agree
+        if axis == 'X':
+            self.x_direction = 'right'
+        else:
+            self.y_direction = 'up'
+        self.applied_backlash[axis] = 0
+
+    def set_backlash_table(self, axis, bands):
+        """bands is a list of (start mm, end mm, backlash mm) in machine coordinates"""
+        self.backlash_table[axis] = sorted(bands)
+        self.save_backlash_table()
+
+    def save_backlash_table(self, path = None):
+        if path is None:
+            path = self.backlash_path
+        with open(path, "w") as f:
+            json.dump({'X': self.x_backlash, 'Y': self.y_backlash, 'table': self.backlash_table}, f, indent=4)
+
+    def load_backlash_table(self, path = None):
+        if path is None:
+            path = self.backlash_path
+        try:
+            with open(path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.x_backlash = saved.get('X', self.x_backlash)
+        self.y_backlash = saved.get('Y', self.y_backlash)
+        for axis in ['X', 'Y']:
+            self.backlash_table[axis] = [tuple(band) for band in saved.get('table', {}).get(axis, [])]
+        return True
 
     def abs_move(self, x, y, z = None, feed = None, level = False, wait = False):
-        self.xyz = self.find_location()
+        self.xyz = self.current_location()
         # print('jeebus')
-        dx = x - self.xyz["X"]
-        dy = y - self.xyz["Y"]
         if feed == None:
             feed = 200
 
-        
-
-        # Backlash correction: only apply if direction changed
-        if dx < 0 and self.x_direction == 'right':
-            dx -= self.x_backlash
-            self.x_direction = 'left'
-        elif dx > 0 and self.x_direction == 'left':
-            dx += self.x_backlash
-            self.x_direction = 'right'
-
-        if dy < 0 and self.y_direction == 'up':
-            dy -= self.y_backlash
-            self.y_direction = 'down'
-        elif dy > 0 and self.y_direction == 'down':
-            dy += self.y_backlash
-            self.y_direction = 'up'
-            # print('up')
+        target_x, target_y = self.backlash_target(x, y, self.xyz)
+        dx = target_x - self.xyz["X"]
+        dy = target_y - self.xyz["Y"]
 
         # Move relative
         if z!= None:
-            self.ser.write("G90\r\n")
-            self.ser.write("G1 Z{z} F200\r\n")
+            self.command("G90")
+            self.command(f"G1 Z{fmt(z)} F200")
 
         if level:
-            self.ser.write("G90\r\n")
-            self.ser.write(f"G1 Z{x*self.m + self.b} F200\r\n")
+            self.command("G90")
+            self.command(f"G1 Z{fmt(self.level_z(x, y))} F200")
         self.rel_move(dx, dy, 0, feed)
-        self.ser.flush()
 
-
-        self.find_location()
-        for i in range(int(-(-(x-self.xyz["X"])//0.06))):
-            self.rel_move(0.06, 0, None, 200)
-        for i in range(int(-(-(y-self.xyz["Y"])//0.06))):
-            self.rel_move(0, 0.06, None, 200)    
+        self.correct_position(target_x, target_y)
 
         if wait:
-            dist = np.hypot(dx,dy)
-            # print("Frog")
-            # print(f"wait {dist/feed}")
-            time.sleep((dist/feed)*100)
-            # print("Frogger")
-
-
-            time.sleep(2)
-            # print("Frosadfasg")
-
+            self.wait_for_idle()
+
+    def wait_for_idle(self, timeout = None):
+        # M400 is only acknowledged once every queued move has finished
+        try:
+            self.ser.wait_for(self.command("M400"), timeout)
+            return True
+        except Exception as e:
+            print(f"printer never went idle: {e}")
+            return False
+
+    def correct_position(self, target_x, target_y, tolerance = None, max_iterations = None):
+        """
+        Measure where the steppers ended up and make one corrective move per axis per pass until
+        it is within tolerance or max_iterations passes are used. Returns the last measured error,
+        None when the position could not be measured. Off unless "correction iterations" is set,
+        measuring waits for the stage to stop and asks the printer on every move.
+        """
+        if tolerance is None:
+            tolerance = self.correction_tolerance
+        if max_iterations is None:
+            max_iterations = self.correction_iterations
+        if max_iterations <= 0:
+            return self.last_move_error
+
+        iterations = 0
+        while True:
+            xyz = self.measure_position()
+            if xyz is None:
+                self.last_move_error = None
+                return None
+            error_x = target_x - xyz["X"]
+            error_y = target_y - xyz["Y"]
+            if iterations >= max_iterations or (abs(error_x) <= tolerance and abs(error_y) <= tolerance):
+                break
+            if abs(error_x) > tolerance:
+                self.rel_move(error_x, 0, None, 200)
+            if abs(error_y) > tolerance:
+                self.rel_move(0, error_y, None, 200)
+            iterations += 1
 
-        # print('meep')
+        self.last_move_error = {'X': error_x, 'Y': error_y}
+        return self.last_move_error
 
     def apply_transformation(self,align1_center, align2_center, align1_real, align2_real, z1, z2):
-        
-        temp = align2_center - align1_center
-        temp1 = align2_real - align1_real
-        theta_image = math.atan2(temp[1,0], temp[0,0])
-        theta_real = math.atan2(temp1[1,0], temp1[0,0])
-        self.rotation = theta_image - theta_real
-
-
-        temp2 = align1_real - align2_real
-        distance = np.hypot(temp[0,0], temp[1,0])
-        ideal_distance = np.hypot(temp2[0,0], temp2[1,0])
-        self.scaling = distance/ideal_distance
-
-        rotation_matrix = np.array([[math.cos(self.rotation), -math.sin(self.rotation)],
-                                    [math.sin(self.rotation), math.cos(self.rotation)]])
-
-        self.displacement = align1_center - ((self.scaling * rotation_matrix) @ align1_real)
-
-        self.displacement = (self.displacement +  align2_center - ((self.scaling * rotation_matrix) @ align2_real))/2.0
-
-
-        self.m = float(z1 - z2) / float(align1_center[0,0] - align2_center[0,0])
-
-        self.b = z1 - self.m*align1_center[0,0]
+        # the original two mark alignment, a similarity transform is exact through two points
+        return self.fit_alignment(np.hstack((align1_center, align2_center)), np.hstack((align1_real, align2_real)),
+                                  [z1, z2], "similarity")
+
+    def fit_alignment(self, machine_points, wafer_points, z, transform = "similarity"):
+        """
+        Least squares wafer to machine transform through any number of marks. machine_points and
+        wafer_points are 2xN in mm, z the focused Z at each mark. transform is "similarity"
+        (rotation, one scale, shift) or "affine" (also shear and separate X/Y scale, needs three
+        marks that are not in a line). Z starts a new height map through the marks, a line along
+        them with only two. Returns the per mark residuals, see alignment_residuals.
+        """
+        machine_points = np.asarray(machine_points, dtype=np.float64)
+        wafer_points = np.asarray(wafer_points, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64).ravel()
+        count = machine_points.shape[1]
+        wx, wy = wafer_points
+        ones = np.ones(count)
+        zeros = np.zeros(count)
+        spread = np.linalg.matrix_rank(np.vstack((wafer_points, ones)))
+
+        if transform == "affine" and count >= 3 and spread == 3:
+            design = np.vstack((np.column_stack((wx, wy, ones, zeros, zeros, zeros)),
+                                np.column_stack((zeros, zeros, zeros, wx, wy, ones))))
+            p = np.linalg.lstsq(design, np.concatenate(machine_points), rcond=None)[0]
+            self.matrix = np.array([[p[0], p[1]], [p[3], p[4]]])
+            self.displacement = np.array([[p[2]], [p[5]]])
+        else:
+            if transform == "affine":
+                print("affine alignment needs three marks that are not in a line, fitting a similarity")
+            # x' = a x - b y + tx, y' = b x + a y + ty
+            design = np.vstack((np.column_stack((wx, -wy, ones, zeros)),
+                                np.column_stack((wy, wx, zeros, ones))))
+            a, b, tx, ty = np.linalg.lstsq(design, np.concatenate(machine_points), rcond=None)[0]
+            self.matrix = np.array([[a, -b], [b, a]])
+            self.displacement = np.array([[tx], [ty]])
+
+        # rotation and scaling still describe the fit, the X/Y average for an affine one
+        self.rotation = math.atan2(self.matrix[1,0] - self.matrix[0,1], self.matrix[0,0] + self.matrix[1,1])
+        self.scaling = math.sqrt(abs(np.linalg.det(self.matrix)))
+
+        # samples from before were taken over the old wafer position
+        mx, my = machine_points
+        self.heights = height_map()
+        for i in range(count):
+            self.heights.add(mx[i], my[i], z[i])
+        self.heights.fit()
+        self.m, self.m_y, self.b = self.heights.plane
+        self.level_offset = 0.0
+        self.transform = wafer_transform(self.matrix, self.displacement, self.heights)
+        fitted_z = self.heights.z(mx, my)
+
+        predicted = self.matrix @ wafer_points + self.displacement
+        self.alignment_residuals = []
+        for i in range(count):
+            self.alignment_residuals.append({
+                'X': float(predicted[0,i] - mx[i]),
+                'Y': float(predicted[1,i] - my[i]),
+                'Z': float(fitted_z[i] - z[i]),
+            })
 
         # print(f"Displacement: {self.displacement}")
         # print(f"rotation: {self.rotation}")
         # print(f"scaling: {self.scaling}")
+        return self.alignment_residuals
+
+    def add_height_sample(self, x, y, z):
+        """
+        Machine Z the needles should sit at above machine point x, y, from a focus or a touchdown.
+        The height map is fitted again with it, returns how far the map was off there.
+        level_offset was a correction on top of the old map, the new one starts without it.
+        """
+        error = self.heights.z(x, y) - z
+        self.heights.add(x, y, z)
+        self.heights.fit()
+        self.m, self.m_y, self.b = self.heights.plane
+        self.level_offset = 0.0
+        return error
+
+    def level_z(self, x, y):
+        """Machine Z the needles sit at above machine point x, y"""
+        return self.transform.z(x, y) + self.level_offset
+
+    def transform_point(self, move):
+        # wafer mm to machine mm, move is 2x1 (or 2xN)
+        return self.transform.xy(move)
 
     def transformed_move(self,move, wait = False):
-        transformed_point = move
-
-        rotation_matrix = np.array([[math.cos(self.rotation), -math.sin(self.rotation)],
-                                    [math.sin(self.rotation), math.cos(self.rotation)]])
-
-        transformed_point = self.scaling * rotation_matrix @ transformed_point
-
-
-        transformed_point = transformed_point + self.displacement
+        transformed_point = self.transform_point(move)
 
         # print('Kanye')
 
         self.abs_move(transformed_point[0,0],transformed_point[1,0],None,200,level=True, wait = wait)
 
     def gcode_waiting(self):
-        
-        time.sleep(0.1)
-        self.ser.flush()
-        timeout = 30
-        start_time = time.time()
-        
-        self.ser.write("M302 S0 \r\n")
-        response = ""
-        
-        while time.time() - start_time < timeout:
-            if self.ser.in_waiting() > 0:
-                char = self.ser.char_read()
-                response += char
-                
-                if 'ok' in response.lower():
-                    time.sleep(0.5)
-                    return True
-                elif 'error' in response.lower():
-                    time.sleep(0.5)
-                    return False
-
-
-
-
-
-
+        errors = len(self.ser.errors)
+        self.command("M302 S0")
+        if not self.ser.drain(timeout=30):
+            return False
+        return len(self.ser.errors) == errors
@@ -0,0 +1,192 @@
+import sys
+import time
+import cv2
+import numpy as np
+
+import json
+from .vision_stuff import frame_pipeline, find_mark, junction_corner, marks, roi_window
+from .capture_stuff import read_recording
+
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+
+def render_polygons(polygons, view_center, microns_per_pixel, shape = (1080, 1920),
+                    bright = 220, dark = 40, blur = 1.5, noise = 8, rng = None):
+    """
+    A camera-like frame of polygons (micron coordinates, y up like GDS) as seen with view_center
+    in the middle of the image: filled, blurred a little and with sensor noise on top.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    height, width = shape
+    image = np.full(shape, dark, dtype=np.uint8)
+    for points in polygons:
+        points = np.asarray(points, dtype=np.float64)
+        px = (points[:, 0] - view_center[0])/microns_per_pixel + width/2
+        py = height/2 - (points[:, 1] - view_center[1])/microns_per_pixel
+        cv2.fillPoly(image, [np.round(np.stack([px, py], axis=1)).astype(np.int32)], bright)
+    if blur:
+        image = cv2.GaussianBlur(image, (0, 0), blur)
+    if noise:
+        image = cv2.add(image, rng.integers(0, noise, shape, dtype=np.uint8))
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def gds_polygons(path, layers = None):
+    """Polygons of the top cell of a GDS file in microns, optionally only some layers"""
+    import gdspy
+    lib = gdspy.GdsLibrary(infile=path)
+    cell = lib.top_level()[0]
+    polygons = []
+    for (layer, datatype), found in cell.get_polygons(by_spec=True).items():
+        if layers is None or layer in layers:
+            polygons.extend(found)
+    return polygons
+
+
+def cross_polygons(center, bar_width = 40, bar_length = 160):
+    # the default mark, same proportions as vision_stuff.shape_template
+    x, y = center
+    w = bar_width/2
+    l = bar_length/2
+    return [[(x - w, y - l), (x + w, y - l), (x + w, y + l), (x - w, y + l)],
+            [(x - l, y - w), (x + l, y - w), (x + l, y + w), (x - l, y + w)]]
+
+
+def synthetic_frames(count = 50, shape = (1080, 1920), microns_per_pixel = 1.0, spread = 150, seed = 0):
+    """
+    (tags, frame) pairs with known answers, alternating a die corner cross ("cross search")
+    and a junction of two crossing lines ("junction") placed up to spread pixels off center.
+    tags 'mark' and 'corner' hold the true full frame pixel position.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    for i in range(count):
+        offset = rng.uniform(-spread, spread, 2)
+        truth = [width/2 + offset[0], height/2 + offset[1]]
+        # frame pixel to microns with the view centered on 0, 0
+        center = (offset[0]*microns_per_pixel, -offset[1]*microns_per_pixel)
+        if i % 2 == 0:
+            polygons = cross_polygons(center, 40*microns_per_pixel, 160*microns_per_pixel)
+            tags = {'frame id': i, 'stage': "cross search", 'mark': truth}
+        else:
+            # two long thin lines, their four inside corners average out to the crossing point
+            polygons = cross_polygons(center, 12*microns_per_pixel, 600*microns_per_pixel)
+            tags = {'frame id': i, 'stage': "junction", 'corner': truth}
+        yield tags, render_polygons(polygons, (0, 0), microns_per_pixel, shape, rng=rng)
+
+
+def gds_frames(path, views, microns_per_pixel, layers = None, shape = (1080, 1920), seed = 0):
+    """(tags, frame) for each view center (microns) over a GDS layout, nothing known about the answer"""
+    rng = np.random.default_rng(seed)
+    polygons = gds_polygons(path, layers)
+    for i, view in enumerate(views):
+        yield {'frame id': i, 'view': list(view)}, render_polygons(polygons, view, microns_per_pixel, shape, rng=rng)
+
+
+def replay(frames, roi_size = None, pyramid_levels = None, max_lines = None, mark = None):
+    """
+    Run every frame through the camera pipeline the way camera_handler does, with no windows,
+    timing each stage on its own. Frames tagged "cross search" also go through find_mark,
+    "junction" and "reprobe" through junction_corner, untagged ones through both. Where a
+    frame carries a true 'mark' or 'corner' position the answer is scored against it.
+    """
+    camera = config["camera"]
+    if roi_size is None:
+        roi_size = int(camera.get("roi size", 0))
+    if pyramid_levels is None:
+        pyramid_levels = int(camera.get("pyramid levels", 2))
+    if max_lines is None:
+        max_lines = int(camera.get("max hough lines", 64))
+    if mark is None:
+        mark = marks[camera.get("mark", "cross")]
+
+    times = {stage: [] for stage in frame_pipeline.stages + ["find mark", "junction corner"]}
+    errors = {'mark': [], 'corner': []}
+    missed = {'mark': 0, 'corner': 0}
+    count = 0
+    start = time.perf_counter()
+
+    for tags, frame in frames:
+        count += 1
+        height, width = frame.shape[:2]
+        center = np.array([[width // 2], [height // 2]])
+        pipeline = frame_pipeline(tags.get('frame id', count), frame, roi_window(frame.shape, roi_size), mark)
+
+        # in dependency order, so each time is that stage alone
+        for stage in frame_pipeline.stages:
+            t = time.perf_counter()
+            pipeline.get(stage)
+            times[stage].append(time.perf_counter() - t)
+
+        stage = tags.get('stage')
+        if stage in (None, "cross search"):
+            t = time.perf_counter()
+            found, confidence = find_mark(pipeline.get("smoothed"), mark, (center - pipeline.origin)[:, 0], pyramid_levels)
+            times["find mark"].append(time.perf_counter() - t)
+            if 'mark' in tags:
+                if found is None:
+                    missed['mark'] += 1
+                else:
+                    error = found + pipeline.origin - np.array(tags['mark']).reshape(2, 1)
+                    errors['mark'].append(float(np.hypot(error[0,0], error[1,0])))
+
+        if stage in (None, "junction", "reprobe"):
+            t = time.perf_counter()
+            found, boost = junction_corner(pipeline.get("smoothed"), pipeline.origin, center, max_lines)
+            times["junction corner"].append(time.perf_counter() - t)
+            if 'corner' in tags:
+                error = found - np.array(tags['corner']).reshape(2, 1)
+                distance = float(np.hypot(error[0,0], error[1,0]))
+                # the fallback answer is the screen center, count it as a miss unless that is right
+                if np.array_equal(found, center) and distance > 2:
+                    missed['corner'] += 1
+                else:
+                    errors['corner'].append(distance)
+
+    report = {'frames': count, 'seconds': time.perf_counter() - start, 'stages': {}, 'accuracy': {}}
+    for stage, taken in times.items():
+        if taken:
+            taken = np.array(taken)*1000
+            report['stages'][stage] = {'calls': len(taken), 'mean ms': float(taken.mean()),
+                                       'p95 ms': float(np.percentile(taken, 95))}
+    report['fps'] = count/report['seconds'] if report['seconds'] > 0 else 0.0
+    for kind in errors:
+        if errors[kind] or missed[kind]:
+            found = np.array(errors[kind]) if errors[kind] else np.zeros(0)
+            report['accuracy'][kind] = {
+                'found': len(found),
+                'missed': missed[kind],
+                'mean px': float(found.mean()) if len(found) else None,
+                'max px': float(found.max()) if len(found) else None,
+            }
+    return report
+
+
+def print_report(report):
+    print(f"{report['frames']} frames in {report['seconds']:.2f}s, {report['fps']:.1f} frames/s")
+    for stage, timing in report['stages'].items():
+        print(f"  {stage:16s} {timing['mean ms']:8.2f} ms mean {timing['p95 ms']:8.2f} ms p95  ({timing['calls']} calls)")
+    for kind, score in report['accuracy'].items():
+        if score['found']:
+            print(f"  {kind}: {score['found']} found, {score['missed']} missed, "
+                  f"error {score['mean px']:.2f} px mean {score['max px']:.2f} px max")
+        else:
+            print(f"  {kind}: none found, {score['missed']} missed")
+
+
+def benchmark(path = None, count = 50, **options):
+    """Replay a recording (path without extension, see capture_stuff.frame_recorder) or synthetic frames and print the report"""
+    if path is None:
+        frames = synthetic_frames(count)
+    else:
+        frames = read_recording(path)
+    report = replay(frames, **options)
+    print_report(report)
+    return report
+
+
+if __name__ == "__main__":
+    # python -m poverty_prober.replay_stuff [recording], from the folder with config.json
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
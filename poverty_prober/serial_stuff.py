@@ -0,0 +1,361 @@
+import serial
+import serial.tools.list_ports
+import time
+import threading
+from concurrent.futures import Future
+
+import json
+
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+
+class serial_handler():
+    def __init__(self):
+        self.ser = None
+        self.ser_name = None
+
+        # streaming sender state, line numbers follow Marlin's N<n> ... *checksum format
+        self.window = int(config["printer defaults"].get("buffer size", 4))
+        self.ack_timeout = float(config["printer defaults"].get("ack timeout", 30))
+        # Marlin says busy every couple of seconds while it works, this much silence means a line got lost
+        self.resend_timeout = float(config["printer defaults"].get("resend timeout", 5))
+        self.line_number = 0
+        self.send_ptr = 1
+        # highest line the printer has taken, every ok that is not answering a Resend moves it on by one
+        self.acked = 0
+        # answers still to come for lines on the wire, a line lost on the way never answers
+        self.in_flight = 0
+        self.history = {}
+        self.futures = {}
+        self.stale_resends = 0
+        self.resend_number = None
+        self.rejecting = False
+        self.last_error = ""
+        self.last_retransmit = 0
+        self.responses = []
+        self.errors = []
+
+        # everything below is shared with the reader thread
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.reader = None
+        self.reading = False
+        self.last_heard = time.time()
+        self.last_position = None
+        self.listeners = {"ok": [], "position": [], "busy": [], "echo": [], "error": [], "resend": [], "other": []}
+
+
+    def list_serial_ports(self):
+        ports = list(serial.tools.list_ports.comports())
+        ports = [port for port in ports if "Bluetooth" not in str(port)]
+        return [str(port.device) for port in ports]
+
+    def connect_serial_port(self, port):
+        try:
+            if self.ser!=None:
+                self.stop_reader()
+                self.ser.close()
+            self.ser = serial.Serial(port, 115200, timeout=1)
+            time.sleep(2)
+            self.reset_stream()
+
+
+        except serial.SerialException as e:
+            return False
+
+        finally:
+            if self.ser!=None and self.ser.is_open:
+                self.ser_name = port
+                return True
+
+    def check_serial(self, ports = None):
+        if self.ser is not None:
+
+            if ports is None:
+                ports = self.list_serial_ports()
+            yeet = False
+            for port in ports:
+                if self.ser_name == port:
+                    yeet = True
+
+            if yeet is False:
+                self.stop_reader()
+                self.ser.close()
+
+            return yeet
+
+    def write(self, message):
+        with self.write_lock:
+            self.ser.write(message.encode())
+            self.ser.flush()
+
+    def flush(self):
+        self.ser.flush()
+        self.ser.reset_input_buffer()
+
+    def read(self):
+        return self.ser.readline().decode(errors="replace").strip()
+
+    def char_read(self):
+        return self.ser.read(1).decode()
+
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def on(self, kind, callback):
+        """Call callback(line) for every line of this kind, runs on the reader thread"""
+        self.listeners[kind].append(callback)
+
+    def start_reader(self):
+        if self.reader is not None and self.reader.is_alive():
+            return
+        self.reading = True
+        self.reader = threading.Thread(target=self.reader_loop, daemon=True)
+        self.reader.start()
+
+    def stop_reader(self):
+        self.reading = False
+        if self.reader is not None and self.reader is not threading.current_thread():
+            self.reader.join(timeout=2)
+        self.reader = None
+        self.fail_pending("serial reader stopped")
+
+    def reader_loop(self):
+        while self.reading:
+            try:
+                line = self.read()  # waits up to the port timeout
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                print(f"serial reader stopped: {e}")
+                self.reading = False
+                self.fail_pending("serial port went away")
+                return
+            if line:
+                self.handle_line(line)
+            else:
+                self.check_stalled()
+
+    def fail_pending(self, reason):
+        with self.lock:
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(reason))
+            self.futures = {}
+            self.lock.notify_all()
+
+    def reset_stream(self):
+        """Forget anything in flight and restart line numbering on the printer"""
+        self.stop_reader()
+        with self.lock:
+            self.line_number = 0
+            self.send_ptr = 1
+            self.acked = -1
+            self.history = {}
+            self.futures = {0: Future()}
+            self.stale_resends = 0
+            self.resend_number = None
+            self.rejecting = False
+            self.last_error = ""
+            self.responses = []
+            self.errors = []
+            self.flush()
+            # unnumbered, but still answered with an ok
+            self.write("M110 N0\n")
+            self.in_flight = 1
+            self.last_heard = time.time()
+        self.start_reader()
+
+    def send(self, command):
+        """Queue one line of gcode, the returned future resolves with the printer's reply once it is acknowledged"""
+        future = Future()
+        command = command.strip()
+        if not command:
+            future.set_result([])
+            return future
+        with self.lock:
+            self.line_number += 1
+            body = f"N{self.line_number} {command}"
+            checksum = 0
+            for char in body:
+                checksum ^= ord(char)
+            self.history[self.line_number] = f"{body}*{checksum}\n"
+            self.futures[self.line_number] = future
+            self.release()
+        return future
+
+    def release(self):
+        # caller holds self.lock
+        while self.send_ptr <= self.line_number and self.in_flight < self.window:
+            self.write(self.history[self.send_ptr])
+            self.in_flight += 1
+            self.send_ptr += 1
+
+    def handle_line(self, line):
+        lowered = line.lower()
+        with self.lock:
+            self.last_heard = time.time()
+            if lowered.startswith("ok"):
+                kind = "ok"
+                self.in_flight = max(0, self.in_flight - 1)
+                if self.rejecting:
+                    # closes an Error/Resend, the line it answers gets sent again
+                    self.rejecting = False
+                elif self.acked < self.send_ptr - 1:
+                    self.acknowledge(self.acked + 1)
+                self.responses = []
+                self.release()
+                self.lock.notify_all()
+            elif lowered.startswith("resend:") or lowered.startswith("rs:"):
+                kind = "resend"
+                self.rejecting = True
+                self.request_resend(int(line.split(":", 1)[1].split()[0]))
+            elif lowered.startswith("error"):
+                kind = "error"
+                print(f"printer error: {line}")
+                self.errors.append(line)
+                self.last_error = lowered
+            elif "busy" in lowered:
+                kind = "busy"
+            elif lowered.startswith("echo"):
+                kind = "echo"
+                self.responses.append(line)
+            elif 'X:' in line and 'Y:' in line and 'Z:' in line:
+                kind = "position"
+                self.responses.append(line)
+                self.last_position = line
+            else:
+                kind = "other"
+                self.responses.append(line)
+
+        for callback in self.listeners[kind]:
+            callback(line)
+
+    def acknowledge(self, number):
+        # caller holds self.lock, the printer has taken every line up to number
+        while self.acked < number:
+            self.acked += 1
+            # keep a little history around, a Resend can arrive for a line that was already acknowledged
+            self.history.pop(self.acked - 64, None)
+            future = self.futures.pop(self.acked, None)
+            if future is not None and not future.done():
+                future.set_result(self.responses)
+            self.responses = []
+
+    def request_resend(self, number):
+        # caller holds self.lock
+        # asking for number means everything before it got there, including a line sent twice whose ok got lost
+        self.acknowledge(number - 1)
+        # every line already in flight behind the bad one comes back with its own Resend for the same number
+        if self.stale_resends > 0 and number == self.resend_number:
+            self.stale_resends -= 1
+            return
+        if number == self.line_number + 1:
+            # a line sent twice, the printer only wants what comes next
+            self.send_ptr = number
+            return
+        if number not in self.history:
+            print(f"printer asked for line {number} again but it is not in history")
+            self.errors.append(f"Resend: {number}")
+            return
+        print(f"printer asked to resend from line {number}")
+        self.errors.append(f"Resend: {number}")
+        # a line number complaint about a line we did send means that line never arrived and will never answer
+        lost = "line number" in self.last_error and number < self.send_ptr
+        if lost:
+            self.in_flight = max(0, self.in_flight - 1)
+        # this Resend answers one line, the rest of what is on the wire answers after it
+        self.stale_resends = max(0, self.in_flight - 1)
+        self.resend_number = number
+        self.send_ptr = number
+
+    def check_stalled(self):
+        """
+        A numbered line lost on the way with nothing sent behind it never gets a Resend, the
+        printer just waits for it. After resend_timeout of silence send the oldest unacknowledged
+        line again on its own. If it had got there after all the printer answers with a Resend
+        for the line after it, which acknowledges it.
+        """
+        with self.lock:
+            if self.acked >= self.send_ptr - 1:
+                return
+            now = time.time()
+            if now - max(self.last_heard, self.last_retransmit) < self.resend_timeout:
+                return
+            number = self.acked + 1
+            self.last_retransmit = now
+            print(f"no ok for line {number} in {self.resend_timeout}s, sending it again")
+            self.errors.append(f"Retransmit: {number}")
+            self.stale_resends = 0
+            self.rejecting = False
+            self.in_flight = 1
+            self.send_ptr = number + 1
+            if number == 0:
+                self.write("M110 N0\n")
+            else:
+                self.write(self.history[number])
+
+    def drain(self, timeout=None):
+        """Block until every queued line has been acknowledged, False if the printer goes quiet for ack_timeout"""
+        start_time = time.time()
+        with self.lock:
+            while self.acked < self.line_number:
+                if not self.reading:
+                    return False
+                now = time.time()
+                if timeout is not None and now - start_time > timeout:
+                    return False
+                if now - self.last_heard > self.ack_timeout:
+                    print(f"no ok from printer in {self.ack_timeout}s, {self.line_number - self.acked} lines unacknowledged")
+                    return False
+                self.lock.wait(0.1)
+        return True
+
+    def wait_for(self, future, timeout=None):
+        """Wait on a send() future for as long as the printer keeps talking"""
+        start_time = time.time()
+        while True:
+            try:
+                return future.result(0.1)
+            except TimeoutError:
+                pass
+            now = time.time()
+            if timeout is not None and now - start_time > timeout:
+                raise TimeoutError(f"no answer in {timeout}s")
+            if now - self.last_heard > self.ack_timeout:
+                raise TimeoutError(f"printer quiet for {self.ack_timeout}s")
+
+    def query(self, command, timeout=None):
+        """Send a command and wait for what the printer said before acknowledging it"""
+        try:
+            return self.wait_for(self.send(command), timeout)
+        except Exception as e:
+            print(f"{command} got no answer: {e}")
+            return None
+
+
+class port_watcher(threading.Thread):
+    """Enumerates serial ports in the background and calls callback(ports) only when the list changes"""
+    def __init__(self, handler, callback, interval = None):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.callback = callback
+        if interval is None:
+            interval = float(config["printer defaults"].get("port scan interval", 1.0))
+        self.interval = interval
+        self.ports = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                ports = self.handler.list_serial_ports()
+            except Exception as e:
+                print(f"could not list serial ports: {e}")
+                ports = self.ports
+            if ports != self.ports:
+                self.ports = ports
+                self.callback(ports)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,275 @@
+import time
+import random
+import threading
+from collections import deque
+
+import json
+
+from .motion_stuff import motion_model
+from .serial_stuff import serial_handler
+
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+
+class virtual_port():
+    """
+    Stands in for a serial.Serial connected to a Marlin printer. Lines are parsed on a worker
+    thread, moves take as long as motion_model says (times time_scale) and sit in a planner of
+    planner_size moves, so ok comes back when the planner has room just like the real thing.
+    latency is added before every reply, drop_rate loses whole incoming lines and error_rate
+    corrupts them so the firmware answers with an error and a Resend.
+    """
+    def __init__(self, latency = 0.0, drop_rate = 0.0, error_rate = 0.0, time_scale = 1.0,
+                 planner_size = 16, timeout = 1, seed = None):
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self.planner_size = planner_size
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.motion = motion_model(config.get("kinematics"))
+
+        self.xyz = {'X': 0.0, 'Y': 0.0, 'Z': 0.0, 'E': 0.0}
+        self.relative = False
+        self.feed = 200
+        self.last_n = 0
+        self.planner = deque()  # finish time of every move still in the planner
+        self.received = []
+
+        self.incoming = deque()
+        self.outgoing = deque()
+        self.partial = b""
+        self.lock = threading.Condition()
+        self.is_open = True
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # pyserial side
+    @property
+    def in_waiting(self):
+        with self.lock:
+            return sum(len(line) for line in self.outgoing)
+
+    def write(self, data):
+        with self.lock:
+            self.partial += data
+            while b"\n" in self.partial:
+                line, self.partial = self.partial.split(b"\n", 1)
+                self.incoming.append(line.decode().strip())
+            self.lock.notify_all()
+        return len(data)
+
+    def readline(self):
+        deadline = time.time() + self.timeout
+        with self.lock:
+            while not self.outgoing:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.is_open:
+                    return b""
+                self.lock.wait(remaining)
+            return self.outgoing.popleft()
+
+    def read(self, size = 1):
+        data = b""
+        while len(data) < size:
+            with self.lock:
+                if not self.outgoing:
+                    break
+                line = self.outgoing.popleft()
+                take = size - len(data)
+                data += line[:take]
+                if line[take:]:
+                    self.outgoing.appendleft(line[take:])
+        return data
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.outgoing.clear()
+
+    def close(self):
+        with self.lock:
+            self.is_open = False
+            self.lock.notify_all()
+
+    # firmware side
+    def reply(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.outgoing.append((text + "\n").encode())
+            self.lock.notify_all()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.incoming and self.is_open:
+                    self.lock.wait(0.1)
+                if not self.is_open:
+                    return
+                line = self.incoming.popleft()
+            if not line:
+                continue
+            # only numbered lines get lost or mangled, the host can't recover an unnumbered one either
+            if line.startswith("N"):
+                if self.random.random() < self.drop_rate:
+                    continue
+                if self.random.random() < self.error_rate:
+                    line = line[:-1] + ("0" if line[-1] != "0" else "1")
+            self.handle(line)
+
+    def handle(self, line):
+        command = line
+        if line.startswith("N"):
+            body, _, checksum = line.partition("*")
+            value = 0
+            for char in body:
+                value ^= ord(char)
+            number, _, command = body.partition(" ")
+            number = int(number[1:])
+            if not checksum or int(checksum) != value:
+                self.line_error(f"Error:checksum mismatch, Last Line: {self.last_n}")
+                return
+            if number != self.last_n + 1 and not command.startswith("M110"):
+                self.line_error(f"Error:Line Number is not Last Line Number+1, Last Line: {self.last_n}")
+                return
+            self.last_n = number
+
+        self.received.append(command)
+        words = command.split()
+        code = words[0].upper()
+        params = {}
+        for word in words[1:]:
+            try:
+                params[word[0].upper()] = float(word[1:])
+            except ValueError:
+                pass
+
+        if code in ("G0", "G1"):
+            self.move(params)
+        elif code == "G28":
+            self.wait_for_planner_room()
+            self.queue_move(self.motion.homing_time)
+            self.wait_until(self.planner[-1])
+            self.xyz.update({'X': 0.0, 'Y': 0.0, 'Z': 0.0})
+        elif code == "G90":
+            self.relative = False
+        elif code == "G91":
+            self.relative = True
+        elif code == "M110":
+            self.last_n = int(params.get('N', 0))
+        elif code == "M114":
+            steps = {axis: round(self.xyz[axis]*self.motion.steps_per_mm[axis]) for axis in ['X', 'Y', 'Z']}
+            self.reply(f"X:{self.xyz['X']:.2f} Y:{self.xyz['Y']:.2f} Z:{self.xyz['Z']:.2f} E:{self.xyz['E']:.2f} "
+                       f"Count X:{steps['X']} Y:{steps['Y']} Z:{steps['Z']}")
+        elif code == "M400":
+            self.wait_until(self.planner[-1] if self.planner else 0)
+        elif code == "M503":
+            m = self.motion
+            self.reply(f"echo:  M92 X{m.steps_per_mm['X']:.2f} Y{m.steps_per_mm['Y']:.2f} Z{m.steps_per_mm['Z']:.2f} E{m.steps_per_mm['E']:.2f}")
+            self.reply(f"echo:  M201 X{m.max_acceleration['X']:.2f} Y{m.max_acceleration['Y']:.2f} Z{m.max_acceleration['Z']:.2f} E{m.max_acceleration['E']:.2f}")
+            self.reply(f"echo:  M203 X{m.max_feedrate['X']:.2f} Y{m.max_feedrate['Y']:.2f} Z{m.max_feedrate['Z']:.2f} E{m.max_feedrate['E']:.2f}")
+            self.reply(f"echo:  M204 P{m.acceleration:.2f} T{m.acceleration:.2f}")
+            self.reply(f"echo:  M205 X{m.jerk['X']:.2f} Y{m.jerk['Y']:.2f} Z{m.jerk['Z']:.2f} E{m.jerk['E']:.2f}")
+        elif code not in ("G17", "G21", "M0", "M82", "M83", "M221", "M302"):
+            self.reply(f"echo:Unknown command: \"{command}\"")
+        self.reply("ok")
+
+    def line_error(self, message):
+        self.reply(message)
+        self.reply(f"Resend: {self.last_n + 1}")
+        self.reply("ok")
+
+    def move(self, params):
+        self.feed = params.get('F', self.feed)
+        delta = {}
+        for axis in self.xyz:
+            if axis in params:
+                target = self.xyz[axis] + params[axis] if self.relative else params[axis]
+                delta[axis] = target - self.xyz[axis]
+                self.xyz[axis] = target
+        self.wait_for_planner_room()
+        self.queue_move(self.motion.move_time(delta, self.feed))
+
+    def queue_move(self, duration):
+        start = max(time.time(), self.planner[-1] if self.planner else 0)
+        self.planner.append(start + duration*self.time_scale)
+
+    def wait_for_planner_room(self):
+        while len(self.planner) >= self.planner_size:
+            self.wait_until(self.planner[0])
+            self.retire()
+        self.retire()
+
+    def retire(self):
+        now = time.time()
+        while self.planner and self.planner[0] <= now:
+            self.planner.popleft()
+
+    def wait_until(self, finish):
+        # Marlin keeps the host alive while it blocks
+        while time.time() < finish:
+            time.sleep(min(2.0*self.time_scale, max(0.0, finish - time.time())))
+            if time.time() < finish:
+                self.reply("echo:busy: processing")
+        self.retire()
+
+
+class virtual_serial_handler(serial_handler):
+    """serial_handler wired to a virtual_port, so probe_handler runs without a printer on a COM port"""
+    def __init__(self, **port_options):
+        super().__init__()
+        self.port_options = port_options
+
+    def list_serial_ports(self):
+        return ["virtual"]
+
+    def connect_serial_port(self, port = "virtual"):
+        if self.ser is not None:
+            self.stop_reader()
+            self.ser.close()
+        self.ser = virtual_port(**self.port_options)
+        self.ser_name = port
+        self.reset_stream()
+        return True
+
+
+def benchmark_motion(points = 50, pitch = 0.2, z_drop = 10, **port_options):
+    """
+    Stream a grid of probe points through probe_handler and the virtual printer, returns
+    (seconds taken, seconds the motion model predicted). Run from the folder with config.json.
+    """
+    import numpy as np
+    from .probing_stuff import probe_handler
+    from .motion_stuff import compile_die_plan, run_plan
+
+    ser = virtual_serial_handler(**port_options)
+    ser.connect_serial_port()
+    prober = probe_handler(ser)
+    # identity alignment 100 mm in, level at Z 5
+    prober.fit_alignment(np.array([[100.0, 110.0], [100.0, 100.0]]), np.array([[0.0, 10.0], [0.0, 0.0]]), [5.0, 5.0])
+
+    side = int(np.ceil(np.sqrt(points)))
+    grid = np.array([[(i % side)*pitch for i in range(points)],
+                     [(i // side)*pitch for i in range(points)]])
+    die_center = np.array([[0.0], [0.0]])
+
+    start_xyz = dict(prober.current_location())
+    plan = compile_die_plan(prober, grid, die_center, z_drop)
+    predicted = prober.motion.plan_time(plan, start_xyz)
+
+    start = time.time()
+    for i in run_plan(prober, plan):
+        pass
+    if plan.error is not None:
+        print(f"benchmark plan failed: {plan.error}")
+    prober.wait_for_idle()
+    taken = time.time() - start
+
+    ser.stop_reader()
+    ser.ser.close()
+    return taken, predicted*ser.ser.time_scale
@@ -0,0 +1,416 @@
+import math
+import time
+import cv2
+import numpy as np
+
+
+class shape_template():
+    """
+    A die mark drawn once: its contour, moments and Hu moments. Matching a frame contour
+    against it only has to compute the frame contour's side.
+    """
+    def __init__(self, bar_width = 40, bar_length = 160, hole_size = 0, canvas = 300):
+        self.bar_width = bar_width
+        self.bar_length = bar_length
+        self.hole_size = hole_size
+
+        image = np.zeros((canvas, canvas), dtype=np.uint8)
+        center = (canvas // 2, canvas // 2)  # center of the canvas
+
+        # Draw vertical bar
+        cv2.rectangle(image, (center[0] - bar_width // 2, center[1] - bar_length // 2),
+                      (center[0] + bar_width // 2, center[1] + bar_length // 2), 255, -1)
+        # Draw horizontal bar
+        cv2.rectangle(image, (center[0] - bar_length // 2, center[1] - bar_width // 2),
+                      (center[0] + bar_length // 2, center[1] + bar_width // 2), 255, -1)
+        cv2.rectangle(image, (center[0] - hole_size // 2, center[1] - hole_size // 2),
+                      (center[0] + hole_size // 2, center[1] + hole_size // 2), 0, -1)
+
+        contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.image = image
+        self.contour = contours[0]
+        self.moments = cv2.moments(self.contour)
+        self.hu = cv2.HuMoments(self.moments).flatten()
+        self.log_hu = log_hu(self.hu)
+
+
+def log_hu(hu):
+    # same scaling cv2.matchShapes uses, tiny moments are treated as missing
+    out = np.zeros(7)
+    for i in range(7):
+        magnitude = abs(hu[i])
+        if magnitude > 1e-5:
+            out[i] = math.copysign(math.log10(magnitude), hu[i])
+    return out
+
+
+def match_score(template, moments):
+    """cv2.matchShapes(template.contour, contour, CONTOURS_MATCH_I1, 0) from the contour's cv2.moments"""
+    other = log_hu(cv2.HuMoments(moments).flatten())
+    score = 0.0
+    for i in range(7):
+        if template.log_hu[i] != 0 and other[i] != 0:
+            score += abs(1.0/other[i] - 1.0/template.log_hu[i])
+    return score
+
+
+template_cache = {}
+marks = {}
+
+
+def get_template(bar_width = 40, bar_length = 160, hole_size = 0):
+    key = (bar_width, bar_length, hole_size)
+    if key not in template_cache:
+        template_cache[key] = shape_template(bar_width, bar_length, hole_size)
+    return template_cache[key]
+
+
+def register_mark(name, bar_width = 40, bar_length = 160, hole_size = 0):
+    """Name a mark geometry so a mask set can pick it, e.g. register_mark("thin cross", 20, 160)"""
+    marks[name] = get_template(bar_width, bar_length, hole_size)
+    return marks[name]
+
+
+register_mark("cross")
+
+
+def roi_window(shape, size, point = None):
+    """
+    (x0, y0, x1, y1) of a size by size window around point (full frame pixels, the image
+    center if None), pushed back inside the frame at the edges. size 0 is the whole frame.
+    """
+    height, width = shape[:2]
+    if not size or (size >= width and size >= height):
+        return (0, 0, width, height)
+    if point is None:
+        point = (width // 2, height // 2)
+    w = min(int(size), width)
+    h = min(int(size), height)
+    x0 = min(max(int(point[0]) - w // 2, 0), width - w)
+    y0 = min(max(int(point[1]) - h // 2, 0), height - h)
+    return (x0, y0, x0 + w, y0 + h)
+
+
+def crop(img, window):
+    # a view, no copy
+    x0, y0, x1, y1 = window
+    return img[y0:y1, x0:x1]
+
+
+def area_filter(binary, min_area = 100):
+    """Keep connected components bigger than min_area, one lookup over the label image instead of a pass per label"""
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    lut = np.where(stats[:, cv2.CC_STAT_AREA] > min_area, 255, 0).astype(np.uint8)
+    lut[0] = 0  # background
+    return lut[labels]
+
+
+def benchmark_area_filter(components = (10, 100, 1000, 5000), shape = (1080, 1920), repeats = 5):
+    """
+    Per frame cost of the old per-label loop against area_filter on synthetic frames with
+    a given number of blobs. Returns a list of (components found, loop ms, lookup ms).
+    """
+    rng = np.random.default_rng(0)
+    results = []
+    for count in components:
+        frame = np.zeros(shape, dtype=np.uint8)
+        for i in range(count):
+            x = int(rng.integers(0, shape[1]))
+            y = int(rng.integers(0, shape[0]))
+            size = int(rng.integers(2, 20))
+            cv2.rectangle(frame, (x, y), (x + size, y + size), 255, -1)
+
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(frame, connectivity=8)
+        start = time.perf_counter()
+        for r in range(repeats):
+            looped = np.zeros_like(frame)
+            for i in range(1, num_labels):
+                if stats[i, cv2.CC_STAT_AREA] > 100:
+                    looped[labels == i] = 255
+        loop_ms = (time.perf_counter() - start)*1000/repeats
+
+        start = time.perf_counter()
+        for r in range(repeats):
+            lut = np.where(stats[:, cv2.CC_STAT_AREA] > 100, 255, 0).astype(np.uint8)
+            lut[0] = 0
+            filtered = lut[labels]
+        lut_ms = (time.perf_counter() - start)*1000/repeats
+
+        assert np.array_equal(looped, filtered)
+        results.append((num_labels - 1, loop_ms, lut_ms))
+    return results
+
+
+def binarize(smoothed, block_size = 51, min_area = 100):
+    """Bright features of a smoothed gray image as a 0/255 mask, the camera pipeline's threshold chain"""
+    clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(8, 8))
+    enhanced = clahe.apply(smoothed)
+    binary = cv2.adaptiveThreshold(enhanced, 255,
+                           cv2.ADAPTIVE_THRESH_MEAN_C,
+                           cv2.THRESH_BINARY, blockSize=block_size, C=-5)
+    median = cv2.medianBlur(binary, 3)
+    final = area_filter(median, min_area)  # Adjust if small features are being removed
+    return cv2.dilate(final, np.ones((3, 3), np.uint8), iterations=1)
+
+
+def mark_candidates(binary, mark, min_area, max_score):
+    # (score, x, y, contour) of every contour shaped like mark, center as floats
+    found = []
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for cnt in contours:
+        if cv2.contourArea(cnt) < min_area:
+            continue
+        M = cv2.moments(cnt)
+        if M["m00"] == 0:
+            continue
+        score = match_score(mark, M)
+        if score < max_score:
+            found.append((score, M["m10"] / M["m00"], M["m01"] / M["m00"], cnt))
+    return found
+
+
+def find_mark(smoothed, mark, center, levels = 2, min_area = 300, max_score = 0.45):
+    """
+    The mark nearest center (x, y) in a smoothed gray image, searched coarse to fine: shapes
+    are picked out of a copy scaled down by 2**levels, then the nearest one is measured again
+    at full resolution in a window around it for a sub-pixel center.
+    Returns (2x1 float center in image pixels, confidence 0..1), or (None, 0) if there is no mark.
+    """
+    scale = 2**levels
+    small = smoothed
+    for i in range(levels):
+        small = cv2.pyrDown(small)
+    # the threshold block has to stay odd and cover about the same feature size
+    block = max(3, (51 // scale) | 1)
+    candidates = mark_candidates(binarize(small, block, 100 // scale**2),
+                                 mark, min_area / scale**2, max_score)
+    if not candidates:
+        return None, 0.0
+
+    nearest = min(candidates, key=lambda c: np.hypot(c[1]*scale - center[0], c[2]*scale - center[1]))
+    coarse = np.array([[nearest[1]*scale], [nearest[2]*scale]])
+    coarse_confidence = 1.0 - nearest[0]/max_score
+
+    # full resolution, only around the candidate
+    x, y, w, h = cv2.boundingRect(nearest[3])
+    size = max(w, h)*scale*3 // 2 + 16
+    window = roi_window(smoothed.shape, max(size, 64), (coarse[0,0], coarse[1,0]))
+    patch = crop(smoothed, window)
+    fine = mark_candidates(binarize(patch, 51 if min(patch.shape) > 51 else block, 100),
+                           mark, min_area, max_score)
+    if not fine:
+        # found small but not at full size, keep the coarse answer and trust it less
+        return coarse, coarse_confidence*0.5
+
+    best = min(fine, key=lambda c: np.hypot(c[1] + window[0] - coarse[0,0], c[2] + window[1] - coarse[1,0]))
+    refined = np.array([[best[1] + window[0]], [best[2] + window[1]]])
+    return refined, 1.0 - best[0]/max_score
+
+
+def laplacian_variance(gray):
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+def tenengrad(gray):
+    # mean squared Sobel gradient, less bothered by sensor noise than the Laplacian
+    gx = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
+    return float(np.mean(gx*gx + gy*gy))
+
+
+def normalized_variance(gray):
+    # contrast over brightness, holds up when the illumination drifts between frames
+    mean = gray.mean()
+    if mean <= 0:
+        return 0.0
+    return float(gray.var()/mean)
+
+
+# every score is bigger when sharper
+focus_scores = {"laplacian": laplacian_variance, "tenengrad": tenengrad, "normalized variance": normalized_variance}
+
+
+def strongest_lines(lines, max_lines = 64):
+    """HoughLinesP output as an (n, 4) float array, only the max_lines longest segments"""
+    segments = lines.reshape(-1, 4).astype(np.float64)
+    if len(segments) > max_lines:
+        lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+        keep = np.argpartition(-lengths, max_lines - 1)[:max_lines]
+        segments = segments[np.sort(keep)]
+    return segments
+
+
+def perpendicular_corners(segments, center, k = 4, threshold_deg = 10):
+    """
+    Intersections of every pair of roughly perpendicular segments, all pairs at once.
+    Returns a (3, m) array of x, y and distance to center for the m <= k nearest, closest first.
+    """
+    x1, y1, x2, y2 = segments.T
+    theta = np.arctan2(y2 - y1, x2 - x1)
+    A = y2 - y1
+    B = x1 - x2
+    C = A * x1 + B * y1
+
+    i, j = np.triu_indices(len(segments), 1)
+    # angle between the lines folded into 0..pi/2, a segment's direction doesn't matter
+    diff = np.abs(theta[i] - theta[j]) % np.pi
+    diff = np.minimum(diff, np.pi - diff)
+    det = A[i] * B[j] - A[j] * B[i]
+    keep = (np.abs(diff - np.pi / 2) < np.deg2rad(threshold_deg)) & (det != 0)
+    i, j, det = i[keep], j[keep], det[keep]
+
+    # truncated to whole pixels like the intersections always were
+    x = np.trunc((B[j] * C[i] - B[i] * C[j]) / det)
+    y = np.trunc((A[i] * C[j] - A[j] * C[i]) / det)
+    distance = np.hypot(x - center[0], y - center[1])
+
+    if len(distance) > k:
+        nearest = np.argpartition(distance, k - 1)[:k]
+    else:
+        nearest = np.arange(len(distance))
+    nearest = nearest[np.argsort(distance[nearest], kind="stable")]
+    return np.vstack((x[nearest], y[nearest], distance[nearest]))
+
+
+def junction_corner(img, origin = None, center = None, max_lines = 64):
+    """
+    Junction corner nearest the screen center in a smoothed gray image, as the mean of the
+    four nearest perpendicular line crossings, in full frame pixels. img may be an roi crop,
+    origin is where it sits in the frame and center the frame center (defaults to the middle
+    of img). boost is 1 or -1 when every crossing is above or below center.
+    """
+    edges = cv2.Canny(img, 50, 150, apertureSize=3)
+
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=20, minLineLength=50, maxLineGap=10)
+
+
+
+    if origin is None:
+        origin = np.array([[0], [0]])
+    if center is None:
+        height, width = img.shape[:2]
+        center = np.array([[width//2],[height//2]]) + origin
+    # intersections are found in img pixels, compare them against the center in the same frame
+    screen_center = center - origin
+
+    
+    if lines is None:
+        # print("No lines detected by HoughLinesP")
+        # Return screen center as fallback
+        return center, 0
+
+
+    # longest segments only, a busy frame can give hundreds and the pairs grow with the square
+    segments = strongest_lines(lines, max_lines)
+    closestpoints = perpendicular_corners(segments, screen_center[:, 0])
+
+    if closestpoints.shape[1] == 0:
+        # lines but no corner between them, same fallback as no lines at all
+        return center, 0
+
+    x = closestpoints[0]
+    y = closestpoints[1]
+
+    all_less = np.all(closestpoints[1, :] < screen_center[1,0])
+
+    all_more = np.all(closestpoints[1, :] > screen_center[1,0])
+
+    if all_less:
+        boost = 1
+    elif all_more:
+        boost = -1
+    else:
+        boost = 0
+
+    centroid_x = np.mean(x)
+    centroid_y = np.mean(y)
+    centroid = np.array([[centroid_x],[centroid_y]]) + origin
+
+    return centroid, boost
+
+
+class frame_pipeline():
+    """
+    The processing stages of one camera frame, each worked out the first time it is asked for
+    and kept after that. get("focus") only runs gray and the Laplacian, get("binary") skips
+    the contour passes, and the overlay drawing only happens when something wants to show it.
+    Stages run on the window (x0, y0, x1, y1) of the frame, origin maps them back.
+    """
+    stages = ["gray", "focus", "smoothed", "binary", "contours", "crosses", "squares", "overlay"]
+
+    def __init__(self, frame_id, frame, window = None, mark = None):
+        self.frame_id = frame_id
+        self.frame = frame
+        if window is None:
+            window = roi_window(frame.shape, 0)
+        self.window = window
+        self.origin = np.array([[window[0]], [window[1]]])
+        if mark is None:
+            mark = marks["cross"]
+        self.mark = mark
+        self.cache = {}
+
+    def get(self, stage):
+        if stage not in self.cache:
+            self.cache[stage] = getattr(self, "compute_" + stage)()
+        return self.cache[stage]
+
+    def compute_gray(self):
+        return cv2.cvtColor(crop(self.frame, self.window), cv2.COLOR_BGR2GRAY)
+
+    def compute_focus(self):
+        return laplacian_variance(self.get("gray"))
+
+    def focus(self, method = "laplacian"):
+        """Sharpness of this frame by any of focus_scores, cached like the stages"""
+        if method == "laplacian":
+            return self.get("focus")
+        key = "focus " + method
+        if key not in self.cache:
+            self.cache[key] = focus_scores[method](self.get("gray"))
+        return self.cache[key]
+
+    def compute_smoothed(self):
+        return cv2.GaussianBlur(self.get("gray"), (3, 3), 1.2)
+
+    def compute_binary(self):
+        return binarize(self.get("smoothed"))
+
+    def compute_contours(self):
+        contours, _ = cv2.findContours(self.get("binary"), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # area once per contour, every later pass filters on it
+        return [(cnt, cv2.contourArea(cnt)) for cnt in contours]
+
+    def compute_crosses(self):
+        # (contour, center) of everything shaped like the mark, in window pixels
+        found = []
+        for cnt, area in self.get("contours"):
+            if area < 500:
+                continue  # skip small stuff
+            M = cv2.moments(cnt)
+            if match_score(self.mark, M) < 0.3 and M["m00"] != 0:  # adjust threshold as needed
+                found.append((cnt, (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))))
+        return found
+
+    def compute_squares(self):
+        found = []
+        for cnt, area in self.get("contours"):
+            if area < 500:
+                continue
+            peri = cv2.arcLength(cnt, True)
+            approx = cv2.approxPolyDP(cnt, 0.02 * peri, True)
+            if len(approx) == 4 and cv2.isContourConvex(approx):
+                M = cv2.moments(approx)
+                if M["m00"] != 0:
+                    found.append((approx, (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))))
+        return found
+
+    def compute_overlay(self):
+        output = cv2.cvtColor(self.get("binary"), cv2.COLOR_GRAY2BGR)
+        for cnt, (cx, cy) in self.get("crosses"):
+            cv2.drawContours(output, [cnt], -1, (0, 255, 255), 2)
+            cv2.putText(output, "cross", (cx - 20, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
+        for approx, (cx, cy) in self.get("squares"):
+            cv2.drawContours(output, [approx], -1, (0, 255, 0), 2)
+            cv2.putText(output, "Square", (cx - 20, cy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
+        return output
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules read config.json from the working directory when they are imported
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
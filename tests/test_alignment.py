@@ -0,0 +1,94 @@
+import math
+
+import numpy as np
+import pytest
+
+from poverty_prober.probing_stuff import probe_handler
+
+
+def machine_from(wafer, rotation, scale, shift):
+    c, s = math.cos(rotation), math.sin(rotation)
+    return scale*np.array([[c, -s], [s, c]]) @ wafer + np.array(shift).reshape(2, 1)
+
+
+@pytest.fixture
+def prober():
+    return probe_handler(None)
+
+
+def test_two_marks_similarity_is_exact(prober):
+    wafer = np.array([[0.0, 40.0], [0.0, 5.0]])
+    machine = machine_from(wafer, 0.02, 1.001, (100.0, 80.0))
+    residuals = prober.fit_alignment(machine, wafer, [5.0, 5.2])
+
+    assert prober.rotation == pytest.approx(0.02)
+    assert prober.scaling == pytest.approx(1.001)
+    assert np.allclose(prober.transform_point(wafer), machine)
+    for r in residuals:
+        assert abs(r['X']) < 1e-9 and abs(r['Y']) < 1e-9
+        # height samples are keyed to the micron
+        assert abs(r['Z']) < 1e-5
+    # Z follows the line between the marks
+    middle = machine.mean(axis=1)
+    assert prober.level_z(middle[0], middle[1]) == pytest.approx(5.1)
+
+
+def test_two_marks_in_y_add_no_x_slope(prober):
+    wafer = np.array([[0.0, 0.0], [0.0, 10.0]])
+    machine = wafer + np.array([[100.0], [100.0]])
+    prober.fit_alignment(machine, wafer, [5.0, 5.5])
+    # beside the marks Z is what it is level with them, never a slope nobody measured
+    assert prober.level_z(110.0, 105.0) == pytest.approx(5.25)
+    assert prober.level_z(90.0, 100.0) == pytest.approx(5.0)
+
+
+def test_three_marks_affine_with_z_plane(prober):
+    wafer = np.array([[0.0, 50.0, 0.0], [0.0, 0.0, 50.0]])
+    matrix = np.array([[1.002, 0.003], [-0.001, 0.998]])
+    machine = matrix @ wafer + np.array([[120.0], [90.0]])
+    z = [5.0 + 0.001*x + 0.002*y for x, y in machine.T]
+    prober.fit_alignment(machine, wafer, z, "affine")
+
+    assert np.allclose(prober.matrix, matrix)
+    assert np.allclose(prober.displacement, [[120.0], [90.0]])
+    x, y = 140.0, 110.0
+    assert prober.level_z(x, y) == pytest.approx(5.0 + 0.001*x + 0.002*y)
+
+
+def test_affine_needs_three_marks_off_a_line(prober):
+    wafer = np.array([[0.0, 10.0, 20.0], [0.0, 0.0, 0.0]])
+    machine = machine_from(wafer, 0.01, 1.0, (100.0, 100.0))
+    prober.fit_alignment(machine, wafer, [5.0, 5.0, 5.0], "affine")
+    # falls back to a similarity, which is exact here
+    assert prober.matrix[0, 0] == pytest.approx(prober.matrix[1, 1])
+    assert np.allclose(prober.transform_point(wafer), machine)
+
+
+def test_many_noisy_marks_least_squares(prober):
+    rng = np.random.default_rng(0)
+    wafer = rng.uniform(-40, 40, (2, 12))
+    machine = machine_from(wafer, -0.015, 0.999, (110.0, 95.0))
+    noisy = machine + rng.normal(0, 0.002, machine.shape)
+    residuals = prober.fit_alignment(noisy, wafer, np.full(12, 5.0))
+
+    assert len(residuals) == 12
+    assert prober.rotation == pytest.approx(-0.015, abs=1e-4)
+    assert prober.scaling == pytest.approx(0.999, abs=1e-4)
+    # residuals are the fit minus the measured marks, so they sum to about nothing
+    assert abs(sum(r['X'] for r in residuals)) < 1e-9
+    assert max(math.hypot(r['X'], r['Y']) for r in residuals) < 0.01
+
+
+def test_batch_transform_matches_point_by_point(prober):
+    wafer = np.array([[0.0, 50.0, 0.0], [0.0, 0.0, 50.0]])
+    machine = machine_from(wafer, 0.01, 1.0, (100.0, 100.0))
+    prober.fit_alignment(machine, wafer, [5.0, 5.1, 4.9])
+    prober.level_offset = 0.02
+
+    points = np.array([[0.0, 1.0, 2.5], [0.0, 0.5, 1.0], [1, 1, 2]])
+    die_center = np.array([[10.0], [20.0]])
+    path = prober.transform.probe_path(points, die_center, prober.level_offset)
+    for i in range(points.shape[1]):
+        xy = prober.transform_point(points[:2, i:i+1] + die_center)
+        assert np.allclose(path[:2, i], xy[:, 0])
+        assert path[2, i] == pytest.approx(prober.level_z(xy[0, 0], xy[1, 0]))
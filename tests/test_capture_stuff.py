@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+
+from poverty_prober.capture_stuff import frame_grabber
+
+
+class slow_camera():
+    """Stands in for a cv2.VideoCapture that delivers a frame every period seconds"""
+    def __init__(self, period = 0.02):
+        self.period = period
+
+    def read(self):
+        time.sleep(self.period)
+        return True, np.zeros((4, 4), dtype=np.uint8)
+
+
+def test_first_after_skips_a_frame_period():
+    grabber = frame_grabber(slow_camera(0.02))
+    try:
+        assert grabber.latest() is not None
+        time.sleep(0.1)
+        t = time.time()
+        frame_id, stamp, frame = grabber.first_after(t)
+        assert stamp > t + grabber.period
+        # the frame read first after t was exposed partly before it
+        assert frame_id >= 2
+        assert any(earlier[1] > t for earlier in grabber.frames if earlier[0] < frame_id)
+    finally:
+        grabber.stop()
+
+
+class no_camera():
+    def read(self):
+        return False, None
+
+
+def test_first_frame_after_is_skipped_until_the_period_is_known():
+    grabber = frame_grabber(no_camera())
+    try:
+        with grabber.lock:
+            grabber.frames.extend([(1, 10.0, None), (2, 10.5, None), (3, 11.0, None)])
+            assert [frame[0] for frame in grabber.exposed_after(9.9)] == [2, 3]
+            grabber.period = 0.5
+            assert [frame[0] for frame in grabber.exposed_after(9.9)] == [2, 3]
+            assert [frame[0] for frame in grabber.exposed_after(9.0)] == [1, 2, 3]
+    finally:
+        grabber.stop()
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from poverty_prober.height_stuff import height_map
+
+
+def surface(x, y):
+    return 5.0 + 0.001*x - 0.002*y + 2e-5*((x - 100)**2 + (y - 100)**2)
+
+
+def filled(samples, **options):
+    heights = height_map(**options)
+    for x, y in samples:
+        heights.add(x, y, surface(x, y))
+    return heights
+
+
+def test_empty_and_single_sample_are_flat():
+    heights = height_map()
+    assert heights.z(3.0, 4.0) == 0.0
+    heights.add(10.0, 10.0, 5.0)
+    assert heights.z(50.0, -20.0) == 5.0
+    assert heights.plane == (0.0, 0.0, 5.0)
+
+
+def test_samples_stacked_in_y_have_no_x_slope():
+    heights = height_map()
+    heights.add(100.0, 100.0, 5.0)
+    heights.add(100.0, 110.0, 5.5)
+    assert heights.plane[0] == pytest.approx(0.0)
+    assert heights.z(110.0, 105.0) == pytest.approx(heights.z(100.0, 105.0))
+    assert heights.z(100.0, 105.0) == pytest.approx(5.25)
+
+
+def test_samples_on_a_diagonal_slope_only_along_it():
+    heights = height_map()
+    for i in range(5):
+        heights.add(100.0 + i, 100.0 + i, 5.0 + 0.01*i)
+    # across the line Z does not change
+    assert heights.z(104.0, 100.0) == pytest.approx(heights.z(102.0, 102.0))
+    assert heights.z(102.0, 102.0) == pytest.approx(5.02)
+
+
+def test_samples_too_close_together_level_flat(capsys):
+    heights = height_map()
+    heights.add(100.0, 100.0, 5.0)
+    heights.add(100.2, 100.1, 5.5)
+    assert heights.z(150.0, 150.0) == pytest.approx(5.25)
+    assert "leveling flat" in capsys.readouterr().out
+
+
+def test_resampling_a_spot_replaces_it():
+    heights = height_map()
+    heights.add(0.0, 0.0, 5.0)
+    heights.add(0.0004, 0.0, 6.0)
+    assert len(heights) == 1
+    assert heights.z(0.0, 0.0) == 6.0
+
+
+def test_three_samples_give_their_plane():
+    heights = filled([(0, 0), (10, 0), (0, 10)], method="spline")
+    heights.fit()
+    m, m_y, b = heights.plane
+    for x, y in [(0, 0), (10, 0), (0, 10)]:
+        assert m*x + m_y*y + b == pytest.approx(surface(x, y))
+    assert heights.centers is None
+
+
+def test_spline_passes_through_samples_and_follows_warp():
+    rng = np.random.default_rng(1)
+    samples = rng.uniform(50, 150, (25, 2))
+    heights = filled(samples, method="spline", smoothing=0, grid_step=0)
+    assert np.max(np.abs(heights.residuals())) < 1e-9
+
+    plane = filled(samples, method="plane", grid_step=0)
+    query = rng.uniform(70, 130, (2, 500))
+    spline_error = np.abs(heights.z(query[0], query[1]) - surface(*query)).max()
+    plane_error = np.abs(plane.z(query[0], query[1]) - surface(*query)).max()
+    assert spline_error < plane_error/2
+
+
+def test_grid_lookup_matches_the_spline():
+    rng = np.random.default_rng(2)
+    samples = rng.uniform(0, 100, (20, 2))
+    direct = filled(samples, grid_step=0)
+    gridded = filled(samples, grid_step=0.5)
+    # inside the grid and outside it, where the spline is used as is
+    query = rng.uniform(-20, 120, (2, 1000))
+    assert np.allclose(gridded.z(query[0], query[1]), direct.z(query[0], query[1]), atol=1e-3)
+
+
+def test_lookup_keeps_the_shape():
+    heights = filled([(0, 0), (10, 0), (0, 10), (10, 10), (5, 3)])
+    assert isinstance(heights.z(1.0, 2.0), float)
+    grid = heights.z(np.zeros((3, 4)), np.ones((3, 4)))
+    assert grid.shape == (3, 4)
+    assert np.allclose(grid, heights.z(0.0, 1.0))
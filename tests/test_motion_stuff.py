@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+from poverty_prober.motion_stuff import motion_model, fmt, compile_die_plan, estimate_job
+from poverty_prober.probing_stuff import probe_handler
+
+
+@pytest.fixture
+def model():
+    return motion_model({
+        "max feedrate X": "200", "max feedrate Y": "200", "max feedrate Z": "12", "max feedrate E": "120",
+        "max acceleration X": "1000", "max acceleration Y": "1000", "max acceleration Z": "200",
+        "max acceleration E": "5000", "acceleration": "1000",
+        "jerk X": "0", "jerk Y": "0", "jerk Z": "0", "jerk E": "0",
+    })
+
+
+def test_no_move_takes_no_time(model):
+    assert model.move_time({}, 1200) == 0.0
+    assert model.move_time({'X': 0, 'Y': 0}, 1200) == 0.0
+
+
+def test_trapezoid(model):
+    # 20 mm/s cruise, 0.2 mm to get up to speed and 0.2 mm to stop
+    speed, acceleration, distance = 20.0, 1000.0, 10.0
+    ramp = speed**2/(2*acceleration)
+    expected = 2*speed/acceleration + (distance - 2*ramp)/speed
+    assert model.move_time({'X': distance}, speed*60) == pytest.approx(expected)
+
+
+def test_triangle_when_the_move_is_too_short_to_cruise(model):
+    distance = 0.1
+    assert model.move_time({'X': distance}, 6000) == pytest.approx(2*math.sqrt(distance/1000.0))
+
+
+def test_slow_axis_limits_the_move(model):
+    # Z tops out at 12 mm/s and 200 mm/s^2 whatever the feed asks for
+    ramp = 12.0**2/(2*200.0)
+    expected = 2*12.0/200.0 + (5.0 - 2*ramp)/12.0
+    assert model.move_time({'Z': 5.0}, 6000) == pytest.approx(expected)
+
+
+def test_extruder_only_counts_alone(model):
+    # E is the length only when nothing else moves, it still holds the speed down when it does
+    assert model.move_time({'E': 15}, 800) == pytest.approx(model.move_time({'X': 15}, 800))
+    assert model.move_time({'X': 1, 'E': 15}, 800) >= model.move_time({'X': 1}, 800)
+
+
+def test_jerk_starts_the_move_faster():
+    slow = motion_model({"jerk X": "0"}).move_time({'X': 1.0}, 6000)
+    fast = motion_model({"jerk X": "8"}).move_time({'X': 1.0}, 6000)
+    assert fast < slow
+
+
+def test_gcode_time_follows_absolute_and_relative(model):
+    absolute = model.gcode_time(["G90", "G1 X10 F1200", "G1 X10"])
+    relative = model.gcode_time(["G91", "G1 X10 F1200", "G1 X10"])
+    assert absolute == pytest.approx(model.move_time({'X': 10}, 1200))
+    assert relative == pytest.approx(2*model.move_time({'X': 10}, 1200))
+
+
+def test_read_m503(model):
+    model.read_m503(["echo:  M203 X150.00 Y150.00 Z10.00 E100.00", "echo:  M204 P800.00 T800.00"])
+    assert model.max_feedrate['X'] == 150.0
+    assert model.acceleration == 800.0
+
+
+def test_estimate_job_chains_the_dies(model):
+    prober = probe_handler(None)
+    prober.position_known = True
+    prober.fit_alignment(np.array([[100.0, 110.0], [100.0, 100.0]]), np.array([[0.0, 10.0], [0.0, 0.0]]), [5.0, 5.0])
+    points = np.array([[0.0, 0.2, 0.4], [0.0, 0.0, 0.2]])
+    dies = [np.array([[0.0], [0.0]]), np.array([[5.0], [0.0]])]
+
+    first = compile_die_plan(prober, points, dies[0], 10)
+    second = compile_die_plan(prober, points, dies[1], 10, start=first.end, backlash=first.end_backlash)
+    expected = model.plan_time(first, prober.xyz) + model.plan_time(second, first.end) + 6*0.5
+    assert estimate_job(model, prober, dies, points, 10, point_overhead=0.5) == pytest.approx(expected)
+    # the second die starts at the first one's last point, not back at the origin
+    assert model.plan_time(second, first.end) < model.plan_time(second, prober.xyz)
+
+
+def test_fmt_never_writes_exponents():
+    assert fmt(1e-05) == "0.0000"
+    assert fmt(-3e-4) == "-0.0003"
+    assert fmt(12.34567) == "12.3457"
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from poverty_prober.virtual_printer import virtual_port, virtual_serial_handler
+from poverty_prober.probing_stuff import probe_handler
+
+
+class slipping_port(virtual_port):
+    """virtual_port whose stage falls short of the next move by slip mm on each axis"""
+    def __init__(self, slip = None, **options):
+        self.slip = dict(slip or {})
+        super().__init__(**options)
+
+    def move(self, params):
+        super().move(params)
+        for axis, short in self.slip.items():
+            self.xyz[axis] -= short
+        self.slip = {}
+
+
+def connect(port):
+    handler = virtual_serial_handler()
+    handler.ser = port
+    handler.ser_name = "virtual"
+    handler.reset_stream()
+    prober = probe_handler(handler)
+    prober.position_known = True
+    return prober
+
+
+def close(prober):
+    prober.ser.stop_reader()
+    prober.ser.ser.close()
+
+
+def test_plain_moves_never_ask_the_printer():
+    prober = connect(virtual_port(time_scale=0.01))
+    prober.correction_iterations = 0
+    for x in [1.0, 2.0, 1.5, 3.0, 0.5]:
+        prober.abs_move(x, 1.0)
+    assert prober.ser.drain(timeout=10)
+    sent = prober.ser.ser.received
+    assert "M400" not in sent
+    assert "M114" not in sent
+    close(prober)
+
+
+def test_correction_measures_the_step_counts():
+    prober = connect(slipping_port(slip={'X': 0.05}, time_scale=0.01))
+    prober.correction_iterations = 2
+    prober.rel_move(1.0, 0.0)
+    error = prober.correct_position(1.0, 0.0)
+    assert error is not None
+    assert abs(error['X']) <= prober.correction_tolerance
+    assert abs(error['Y']) <= prober.correction_tolerance
+    # one corrective move went out for the lost 0.05 mm
+    assert prober.xyz['X'] > 1.04
+    close(prober)
+
+
+def test_correction_gives_up_without_step_counts():
+    class no_count_port(virtual_port):
+        def reply(self, text):
+            super().reply(text.split(" Count")[0])
+
+    prober = connect(no_count_port(time_scale=0.01))
+    prober.correction_iterations = 2
+    assert prober.correct_position(0.0, 0.0) is None
+    close(prober)
+
+
+def test_rounding_noise_does_not_flip_backlash():
+    prober = probe_handler(None)
+    prober.y_direction = 'up'
+    start = {'X': 0.0, 'Y': 0.0, 'Z': 0.0}
+    # a pure X move on a fitted alignment lands a hair below the start in Y
+    x, y = prober.backlash_target(0.2, -1e-12, start)
+    assert prober.y_direction == 'up'
+    assert (x, y) == (0.2, -1e-12)
+    x, y = prober.backlash_target(0.2, -0.01, start)
+    assert prober.y_direction == 'down'
+    assert y == -0.01 - prober.backlash_for('Y', -0.01)
+
+
+def test_height_sample_keeps_the_focus_correction():
+    prober = probe_handler(None)
+    prober.fit_alignment(np.array([[100.0, 110.0], [100.0, 100.0]]), np.array([[0.0, 10.0], [0.0, 0.0]]), [5.0, 5.0])
+    # autofocus found the wafer 30 um above the map and the stage sits there
+    prober.level_offset = 0.03
+    focused = prober.level_z(105.0, 110.0)
+    error = prober.add_height_sample(105.0, 110.0, focused)
+    # the map itself was 30 um off there
+    assert error == pytest.approx(-0.03)
+    assert prober.level_offset == 0.0
+    assert prober.level_z(105.0, 110.0) == pytest.approx(5.03)
+    assert prober.heights.z(105.0, 100.0) == pytest.approx(5.0)
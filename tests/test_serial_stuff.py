@@ -0,0 +1,166 @@
+import time
+
+import numpy as np
+import pytest
+
+from poverty_prober.virtual_printer import virtual_port, virtual_serial_handler
+from poverty_prober.probing_stuff import probe_handler
+from poverty_prober.motion_stuff import compile_die_plan, run_plan
+
+
+class lossy_port(virtual_port):
+    """virtual_port that loses or corrupts chosen numbered lines the first time they are sent"""
+    def __init__(self, drop = (), corrupt = (), silent = False, **options):
+        self.drop = set(drop)
+        self.corrupt = set(corrupt)
+        self.silent = silent
+        super().__init__(**options)
+
+    def write(self, data):
+        line = data.decode()
+        if line.startswith("N"):
+            number = int(line.split()[0][1:])
+            if number in self.drop:
+                self.drop.discard(number)
+                return len(data)
+            if number in self.corrupt:
+                self.corrupt.discard(number)
+                data = line.replace("*", "*9", 1).encode()
+        return super().write(data)
+
+    def reply(self, text):
+        if not self.silent:
+            super().reply(text)
+
+
+def connect(port):
+    handler = virtual_serial_handler()
+    handler.ser = port
+    handler.ser_name = "virtual"
+    handler.resend_timeout = 0.3
+    handler.ack_timeout = 5
+    handler.reset_stream()
+    return handler
+
+
+def moves(count):
+    return [f"G1 X{i} Y{i} F6000" for i in range(1, count + 1)]
+
+
+def received(port):
+    return [line for line in port.received if not line.startswith("M110")]
+
+
+def close(handler):
+    handler.stop_reader()
+    handler.ser.close()
+
+
+def test_stream_in_order():
+    handler = connect(lossy_port(time_scale=0.01))
+    futures = [handler.send(line) for line in moves(10)]
+    assert handler.drain(timeout=10)
+    assert all(future.done() for future in futures)
+    assert received(handler.ser) == moves(10)
+    close(handler)
+
+
+def test_corrupted_line_is_resent():
+    handler = connect(lossy_port(corrupt=[3], time_scale=0.01))
+    for line in moves(8):
+        handler.send(line)
+    assert handler.drain(timeout=10)
+    assert received(handler.ser) == moves(8)
+    assert "Resend: 3" in handler.errors
+    close(handler)
+
+
+def test_line_lost_mid_stream_is_resent():
+    handler = connect(lossy_port(drop=[2], time_scale=0.01))
+    for line in moves(8):
+        handler.send(line)
+    assert handler.drain(timeout=10)
+    assert received(handler.ser) == moves(8)
+    close(handler)
+
+
+def test_lost_last_line_is_retransmitted():
+    # nothing behind it, so the printer never asks for it
+    handler = connect(lossy_port(drop=[3], time_scale=0.01))
+    futures = [handler.send(line) for line in moves(3)]
+    handler.wait_for(futures[-1], timeout=5)
+    assert received(handler.ser) == moves(3)
+    assert "Retransmit: 3" in handler.errors
+    close(handler)
+
+
+def test_retransmitted_duplicate_is_acknowledged():
+    handler = connect(lossy_port(time_scale=0.01))
+    future = handler.send("G1 X1 F6000")
+    handler.wait_for(future, timeout=5)
+    # pretend the ok never came, the printer answers the second copy with a Resend for the next line
+    with handler.lock:
+        handler.acked -= 1
+        handler.last_heard = time.time() - 1
+    handler.check_stalled()
+    assert handler.drain(timeout=5)
+    after = handler.send("G1 X2 F6000")
+    handler.wait_for(after, timeout=5)
+    assert received(handler.ser) == ["G1 X1 F6000", "G1 X2 F6000"]
+    close(handler)
+
+
+def test_quiet_printer_times_out():
+    handler = connect(lossy_port(silent=True))
+    handler.ack_timeout = 0.5
+    with pytest.raises(TimeoutError):
+        handler.wait_for(handler.send("G1 X1 F6000"))
+    close(handler)
+
+
+def test_run_plan_stops_on_timeout():
+    handler = connect(lossy_port(time_scale=0.01))
+    prober = probe_handler(handler)
+    prober.correction_iterations = 0
+    prober.fit_alignment(np.array([[100.0, 110.0], [100.0, 100.0]]), np.array([[0.0, 10.0], [0.0, 0.0]]), [5.0, 5.0])
+    plan = compile_die_plan(prober, np.array([[0.0, 0.2], [0.0, 0.0]]), np.zeros((2, 1)), 10)
+
+    handler.ser.silent = True
+    handler.ack_timeout = 0.5
+    handler.resend_timeout = 10
+    start = time.time()
+    assert list(run_plan(prober, plan)) == []
+    assert plan.error is not None
+    assert time.time() - start < 5
+    close(handler)
+
+
+def test_wait_for_idle_reports_a_quiet_printer():
+    # camera_handler.wait_for_stage turns this into the TimeoutError plot_die lifts the needles on
+    handler = connect(lossy_port(silent=True))
+    handler.ack_timeout = 0.5
+    prober = probe_handler(handler)
+    prober.position_known = True
+    assert not prober.wait_for_idle()
+    close(handler)
+
+
+def test_backlash_flags_follow_the_lines_sent():
+    handler = connect(lossy_port(time_scale=0.01))
+    prober = probe_handler(handler)
+    prober.correction_iterations = 0
+    prober.fit_alignment(np.array([[100.0, 110.0], [100.0, 100.0]]), np.array([[0.0, 10.0], [0.0, 0.0]]), [5.0, 5.0])
+    prober.x_direction = 'right'
+    # out to 0.2 and back to 0, the second point reverses X
+    plan = compile_die_plan(prober, np.array([[0.2, 0.0], [0.0, 0.0]]), np.zeros((2, 1)), 10)
+    assert prober.x_direction == 'right'
+    assert plan.end_backlash[0] == 'left'
+
+    # cancelled while the needles are down on the first point
+    points = run_plan(prober, plan)
+    assert next(points) == 0
+    points.close()
+    assert handler.drain(timeout=5)
+    assert prober.x_direction == 'right'
+    assert prober.applied_backlash['X'] == 0
+    close(handler)
@@ -0,0 +1,172 @@
+import cv2
+import numpy as np
+import pytest
+
+from poverty_prober.vision_stuff import get_template, match_score, area_filter, roi_window, crop, junction_corner
+from poverty_prober.vision_stuff import perpendicular_corners, find_mark, frame_pipeline, marks
+from poverty_prober.replay_stuff import synthetic_frames
+
+
+def contour_of(image):
+    contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return max(contours, key=cv2.contourArea)
+
+
+def shapes():
+    cross = get_template(30, 120).image
+    rotated = cv2.warpAffine(get_template().image, cv2.getRotationMatrix2D((150, 150), 20, 0.8), (300, 300))
+    square = np.zeros((300, 300), dtype=np.uint8)
+    cv2.rectangle(square, (50, 80), (200, 160), 255, -1)
+    circle = np.zeros((300, 300), dtype=np.uint8)
+    cv2.circle(circle, (150, 150), 90, 255, -1)
+    return [cross, rotated, square, circle]
+
+
+@pytest.mark.parametrize("image", shapes())
+def test_match_score_is_match_shapes(image):
+    template = get_template()
+    contour = contour_of(image)
+    expected = cv2.matchShapes(template.contour, contour, cv2.CONTOURS_MATCH_I1, 0)
+    assert match_score(template, cv2.moments(contour)) == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+def test_templates_are_built_once():
+    assert get_template(40, 160, 0) is get_template(40, 160, 0)
+    assert get_template(20, 160, 0) is not get_template(40, 160, 0)
+
+
+def looped_area_filter(binary, min_area):
+    # the per label loop area_filter replaced
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    out = np.zeros_like(binary)
+    for i in range(1, num_labels):
+        if stats[i, cv2.CC_STAT_AREA] > min_area:
+            out[labels == i] = 255
+    return out
+
+
+def test_area_filter_matches_the_label_loop():
+    rng = np.random.default_rng(1)
+    binary = np.zeros((240, 320), dtype=np.uint8)
+    for i in range(200):
+        x, y = int(rng.integers(0, 320)), int(rng.integers(0, 240))
+        size = int(rng.integers(1, 16))
+        cv2.rectangle(binary, (x, y), (x + size, y + size), 255, -1)
+    # exactly min_area pixels is dropped, one more is kept
+    binary[:, 300:] = 0
+    binary[0:10, 305:315] = 255
+    binary[20:30, 305:315] = 255
+    binary[30, 305] = 255
+    filtered = area_filter(binary, 100)
+    assert np.array_equal(filtered, looped_area_filter(binary, 100))
+    assert not filtered[0:10, 305:315].any()
+    assert filtered[20:31, 305].all()
+
+
+def test_roi_window_centers_and_stays_inside():
+    shape = (480, 640)
+    assert roi_window(shape, 0) == (0, 0, 640, 480)
+    assert roi_window(shape, 1000) == (0, 0, 640, 480)
+    assert roi_window(shape, 100) == (270, 190, 370, 290)
+    assert roi_window(shape, 100, (10, 470)) == (0, 380, 100, 480)
+    assert roi_window(shape, 100, (639, 0)) == (540, 0, 640, 100)
+    # taller than the frame, the window is cut to the frame height
+    assert roi_window(shape, 600, (320, 240)) == (20, 0, 620, 480)
+
+
+def test_crop_is_a_view_in_frame_pixels():
+    frame = np.arange(480*640).reshape(480, 640)
+    window = roi_window(frame.shape, 100, (400, 300))
+    patch = crop(frame, window)
+    assert patch.shape == (100, 100)
+    assert np.shares_memory(patch, frame)
+    # a pixel in the patch plus the window origin is the same pixel in the frame
+    assert patch[7, 11] == frame[window[1] + 7, window[0] + 11]
+
+
+def test_junction_corner_on_a_window_reports_frame_pixels():
+    frame = np.zeros((480, 640), dtype=np.uint8)
+    # one corner of a pad that runs off the frame
+    cv2.rectangle(frame, (300, 200), (700, 600), 255, -1)
+    frame = cv2.GaussianBlur(frame, (5, 5), 0)
+    center = np.array([[320], [240]])
+    whole, whole_boost = junction_corner(frame, None, center)
+    window = roi_window(frame.shape, 200, (320, 240))
+    origin = np.array([[window[0]], [window[1]]])
+    windowed, windowed_boost = junction_corner(crop(frame, window), origin, center)
+    assert np.allclose(windowed, whole, atol=1.0)
+    assert windowed_boost == whole_boost
+    assert np.allclose(whole, [[300], [200]], atol=2.0)
+
+
+def looped_corners(segments, center, k = 4, threshold_deg = 10):
+    # the pair loop perpendicular_corners replaced, k nearest crossings sorted by distance
+    found = []
+    for i in range(len(segments)):
+        for j in range(i + 1, len(segments)):
+            x1, y1, x2, y2 = segments[i]
+            x3, y3, x4, y4 = segments[j]
+            diff = abs(np.arctan2(y2 - y1, x2 - x1) - np.arctan2(y4 - y3, x4 - x3))
+            diff = min(diff, np.pi - diff)
+            if abs(diff - np.pi/2) >= np.deg2rad(threshold_deg):
+                continue
+            A1, B1 = y2 - y1, x1 - x2
+            C1 = A1*x1 + B1*y1
+            A2, B2 = y4 - y3, x3 - x4
+            C2 = A2*x3 + B2*y3
+            det = A1*B2 - A2*B1
+            if det == 0:
+                continue
+            x, y = int((B2*C1 - B1*C2)/det), int((A1*C2 - A2*C1)/det)
+            found.append((np.hypot(x - center[0], y - center[1]), x, y))
+    found.sort()
+    return np.array([[x for d, x, y in found[:k]], [y for d, x, y in found[:k]], [d for d, x, y in found[:k]]])
+
+
+def test_perpendicular_corners_match_the_pair_loop():
+    rng = np.random.default_rng(2)
+    for trial in range(20):
+        segments = rng.uniform(0, 400, (30, 4))
+        # left to right, so every angle difference is under pi like the loop assumed
+        segments[:, [0, 2]] = np.sort(segments[:, [0, 2]], axis=1)
+        center = rng.uniform(100, 300, 2)
+        expected = looped_corners(segments, center)
+        assert np.allclose(perpendicular_corners(segments, center), expected.reshape(3, -1))
+
+
+def test_perpendicular_corners_ignore_segment_direction():
+    center = np.array([0.0, 0.0])
+    down = np.array([[10.0, 20.0, 10.0, -20.0], [-20.0, 5.0, 20.0, 5.0]])
+    # the same two lines with the second one drawn right to left
+    flipped = np.array([[10.0, 20.0, 10.0, -20.0], [20.0, 5.0, -20.0, 5.0]])
+    assert np.allclose(perpendicular_corners(down, center), [[10], [5], [np.hypot(10, 5)]])
+    assert np.allclose(perpendicular_corners(flipped, center), perpendicular_corners(down, center))
+
+
+def smoothed(frame):
+    return frame_pipeline(0, frame).get("smoothed")
+
+
+def test_find_mark_on_synthetic_crosses():
+    frames = [(tags, frame) for tags, frame in synthetic_frames(8, shape=(480, 640), spread=100, seed=3)
+              if tags['stage'] == "cross search"]
+    for tags, frame in frames:
+        center, confidence = find_mark(smoothed(frame), marks["cross"], (320, 240), levels=2)
+        assert center is not None
+        assert np.hypot(center[0, 0] - tags['mark'][0], center[1, 0] - tags['mark'][1]) < 2.0
+        assert confidence > 0.2
+
+
+def test_find_mark_coarse_to_fine_agrees_with_full_resolution():
+    tags, frame = next(synthetic_frames(1, shape=(480, 640), spread=100, seed=4))
+    image = smoothed(frame)
+    pyramid, _ = find_mark(image, marks["cross"], (320, 240), levels=2)
+    full, _ = find_mark(image, marks["cross"], (320, 240), levels=0)
+    assert np.allclose(pyramid, full, atol=0.5)
+
+
+def test_find_mark_without_a_mark():
+    frame = np.full((480, 640, 3), 40, dtype=np.uint8)
+    center, confidence = find_mark(smoothed(frame), marks["cross"], (320, 240))
+    assert center is None
+    assert confidence == 0.0